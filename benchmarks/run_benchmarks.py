@@ -0,0 +1,338 @@
+"""
+Offline benchmarks of the mining pipeline on a synthetic repo and canned GumTree outputs.
+
+    python benchmarks/run_benchmarks.py                      # run all stages, compare with baseline.json
+    python benchmarks/run_benchmarks.py --save-baseline      # store the results as the new baseline
+    python benchmarks/run_benchmarks.py --stages extract dotfiles --commits 2000
+
+Every stage runs in a fresh process, so its peak RSS is its own. The real GumTree stage is reported as
+skipped when Java is not installed, any other error, missing Python packages included, fails the stage
+and the run.
+
+benchmarks/baseline.json holds the results of the default configuration on a reference machine. It only
+compares on the same configuration and, being wall time, on similar hardware: record a local baseline with
+--save-baseline before measuring a change. Saving keeps the stored results of the stages that did not run.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, 'src'))
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic import PROJECT, REPO_NAME, make_dot, make_repo  # noqa: E402
+
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+DOT_SIZES = [100, 1000, 10000]
+
+
+def use_root(root):
+    """
+    points the data, index and log locations of the pipeline modules at the benchmark directory
+    """
+    import commit_index
+    import gitminer
+    import subtree_store
+    data = os.path.join(root, 'data')
+    gitminer.data_path = subtree_store.data_path = data
+    commit_index.index_path = os.path.join(root, 'cache', 'commits')
+    os.chdir(os.path.join(root, 'work'))
+
+
+def use_gumtree(root):
+    """
+    use_root for the stages of gumtree.py, only they need its PyDriller imports
+    """
+    import gumtree
+    use_root(root)
+    gumtree.data_path = os.path.join(root, 'data')
+    return gumtree
+
+
+class MissingTool(Exception):
+    """
+    an optional external tool of a stage is not installed, the stage is reported as skipped
+    """
+
+
+def repo_commits(root):
+    with open(os.path.join(root, 'commits.json')) as file:
+        return json.load(file)
+
+
+def stage_szz(root, config):
+    import pandas as pd
+    from gitminer import GitMiner
+    use_root(root)
+    fixes = [h for h, is_fix in repo_commits(root) if is_fix]
+    miner = GitMiner()
+    miner.repo_dir = os.path.join(root, 'repos')
+    miner.proj_repo = {PROJECT: ['apache/' + REPO_NAME]}
+    data = miner.run_collector(pd.DataFrame({'commit_id': fixes, 'project': PROJECT}), PROJECT,
+                               workers=config['workers'])
+    return {'commits': len(fixes), 'links': len(data['fix_hash'])}
+
+
+def stage_clean(root, config, fast=False):
+    from gitminer import GitMiner
+    use_root(root)
+    shutil.rmtree(os.path.join(root, 'data', 'clean_parts'), ignore_errors=True)
+    miner = GitMiner()
+    miner.repo_dir = os.path.join(root, 'repos')
+    miner.proj_repo = {PROJECT: ['apache/' + REPO_NAME]}
+    if fast:
+        miner.collect_clean_fast(workers=config['workers'])
+    else:
+        miner.collect_clean()
+    return {'commits': len(repo_commits(root))}
+
+
+def stage_clean_fast(root, config):
+    return stage_clean(root, config, fast=True)
+
+
+def filter_handler(root):
+    RunHandler = use_gumtree(root).RunHandler
+    return RunHandler(commit_file='candidates.csv', ast_filename='bench_subtrees',
+                      already_file='bench_keys.csv', types=['.java'], repo_dir=os.path.join(root, 'repos'))
+
+
+def stage_filter(root, config):
+    handler = filter_handler(root)
+    handler.filter_commits()
+    return {'commits': len(handler.commits)}
+
+
+def stage_filter_bulk(root, config):
+    handler = filter_handler(root)
+    handler.filter_commits_bulk()
+    return {'commits': len(handler.commits)}
+
+
+def canned_dots(root):
+    dots = dict()
+    for n in DOT_SIZES:
+        with open(os.path.join(root, 'dots', 'F{}.dot'.format(n))) as file:
+            dots['F{}_b.java'.format(n)] = file.read()
+    return dots
+
+
+def canned_gumtree(dots):
+    from gumtree import GumTreeDiff
+
+    class CannedGumTreeDiff(GumTreeDiff):
+        """
+        writes the file pairs like GumTreeDiff but answers with a canned dotdiff output
+        """
+        def run_gumtree(self, b_file, a_file):
+            return dots[os.path.basename(b_file)]
+
+    return CannedGumTreeDiff()
+
+
+def stage_dotfiles(root, config):
+    use_gumtree(root)
+    gumtree = canned_gumtree(canned_dots(root))
+    pairs, lines = 0, 0
+    for _ in range(config['repeat']):
+        for n in DOT_SIZES:
+            before, after = gumtree.get_dotfiles(('src/F{}.java'.format(n), 'class A {}', 'class B {}'))
+            pairs += 1
+            lines += len(before) + len(after)
+    return {'file pairs': pairs, 'dot lines': lines}
+
+
+def stage_gumtree(root, config):
+    GumTreeDiff = use_gumtree(root).GumTreeDiff
+    if shutil.which('java') is None:
+        raise MissingTool('java is not installed')
+    repo = os.path.join(root, 'repos', REPO_NAME)
+    commits = [h for h, _ in repo_commits(root)][1:config['gumtree_pairs'] + 1]
+    gumtree = GumTreeDiff(backend=config['backend'], workers=config['workers'])
+    pairs = 0
+    for h in commits:
+        names = subprocess.run(['git', '-C', repo, 'diff', '--name-only', h + '^', h, '--', '*.java'],
+                               stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.split()
+        for name in names:
+            before, after = (subprocess.run(['git', '-C', repo, 'show', '{}:{}'.format(rev, name)],
+                                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+                             for rev in (h + '^', h))
+            gumtree.get_dotfiles((name, before, after))
+            pairs += 1
+    gumtree.close()
+    return {'file pairs': pairs}
+
+
+def stage_extract(root, config):
+    SubTreeExtractor = use_gumtree(root).SubTreeExtractor
+    gumtree = canned_gumtree(canned_dots(root))
+    dotfiles = [gumtree.get_dotfiles(('src/F{}.java'.format(n), '', '')) for n in DOT_SIZES]
+    lines = 0
+    for _ in range(config['repeat']):
+        for before, after in dotfiles:
+            SubTreeExtractor(before).extract_subtree()
+            SubTreeExtractor(after).extract_subtree()
+            lines += len(before) + len(after)
+    return {'dot lines': lines}
+
+
+STAGES = {'szz': stage_szz, 'clean': stage_clean, 'clean_fast': stage_clean_fast, 'filter': stage_filter,
+          'filter_bulk': stage_filter_bulk, 'dotfiles': stage_dotfiles, 'gumtree': stage_gumtree,
+          'extract': stage_extract}
+
+
+def measure(name, root, config):
+    """
+    runs in a fresh process: times one stage and reports its counts and the peak RSS of it and its children
+    """
+    start = time.perf_counter()
+    counts = STAGES[name](root, config)
+    seconds = time.perf_counter() - start
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    return {'seconds': seconds, 'rss_mb': rss, 'counts': counts,
+            'throughput': {unit: n / seconds for unit, n in counts.items()}}
+
+
+def stage_process(name, root, config, conn):
+    try:
+        conn.send(measure(name, root, config))
+    except MissingTool as e:
+        conn.send({'skipped': str(e)})
+    except Exception as e:
+        conn.send({'failed': '{}: {}'.format(type(e).__name__, e)})
+        raise
+
+
+def run_stage(name, root, config):
+    # a plain process rather than a pool worker, stages start their own pools
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=stage_process, args=(name, root, config, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:  # the stage crashed before sending its result
+        result = None
+    process.join()
+    if result is None:
+        result = {'failed': 'exit code {}'.format(process.exitcode)}
+    return result
+
+
+def prepare(root, config):
+    """
+    generates the synthetic repo and the input files of the stages, once per configuration
+    """
+    marker = os.path.join(root, 'config.json')
+    if os.path.isfile(marker):
+        with open(marker) as file:
+            if json.load(file) == config['repo']:
+                return
+    shutil.rmtree(root, ignore_errors=True)
+    for directory in ('repos', 'data', 'work', 'cache', 'dots'):
+        os.makedirs(os.path.join(root, directory))
+    for n in DOT_SIZES:
+        with open(os.path.join(root, 'dots', 'F{}.dot'.format(n)), 'w') as file:
+            file.write(make_dot(n, seed=n))
+    commits = make_repo(os.path.join(root, 'repos', REPO_NAME), **config['repo'])
+    with open(os.path.join(root, 'commits.json'), 'w') as file:
+        json.dump(commits, file)
+    data = os.path.join(root, 'data')
+    with open(os.path.join(data, 'bug_fix_all.csv'), 'w') as file:
+        file.write('commit_id\n' + ''.join(h + '\n' for h, is_fix in commits if is_fix))
+    with open(os.path.join(data, 'candidates.csv'), 'w') as file:
+        file.write('commit_id,project\n' + ''.join('{},apache/{}\n'.format(h, REPO_NAME)
+                                                   for h, is_fix in commits if not is_fix))
+    with open(os.path.join(data, 'bench_keys.csv'), 'w') as file:
+        file.write('commit_id\n')
+    with open(marker, 'w') as file:
+        json.dump(config['repo'], file)
+
+
+def compare(results, baseline, tolerance):
+    """
+    prints each stage against the baseline, returns the stages that got slower by more than tolerance
+    """
+    regressions = []
+    print('{:<12} {:>9} {:>9} {:>8} {:>9}  {}'.format('stage', 'seconds', 'baseline', 'ratio', 'RSS MB', 'throughput'))
+    for name, result in results.items():
+        if 'skipped' in result or 'failed' in result:
+            print('{:<12} {}'.format(name, ', '.join('{}: {}'.format(k, v) for k, v in result.items())))
+            continue
+        base = baseline.get(name, {}).get('seconds')
+        ratio = result['seconds'] / base if base else None
+        throughput = ', '.join('{:.1f} {}/s'.format(v, unit) for unit, v in result['throughput'].items())
+        print('{:<12} {:9.3f} {:>9} {:>8} {:9.1f}  {}'.format(
+            name, result['seconds'], '{:.3f}'.format(base) if base else '-',
+            '{:.2f}x'.format(ratio) if ratio else '-', result['rss_mb'], throughput))
+        if ratio is not None and ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", nargs='*', default=list(STAGES), choices=list(STAGES), help="")
+    parser.add_argument("--commits", default=500, type=int, help="commits of the synthetic repo")
+    parser.add_argument("--files", default=50, type=int, help="java files of the synthetic repo")
+    parser.add_argument("--churn", default=3, type=int, help="files changed per commit")
+    parser.add_argument("--fix-rate", default=0.2, type=float, help="share of fixing commits")
+    parser.add_argument("--seed", default=0, type=int, help="")
+    parser.add_argument("--repeat", default=5, type=int, help="passes over the canned dot outputs")
+    parser.add_argument("--gumtree-pairs", default=20, type=int, help="commits diffed by the real GumTree stage")
+    parser.add_argument("--backend", default='process', choices=['process', 'worker'], help="GumTree backend")
+    parser.add_argument("--workers", default=1, type=int, help="")
+    parser.add_argument("--runs", default=3, type=int, help="runs per stage, the fastest is reported")
+    parser.add_argument("--work-dir", default=None, type=str, help="keeps the synthetic repo between runs")
+    parser.add_argument("--baseline", default=BASELINE_FILE, type=str, help="")
+    parser.add_argument("--save-baseline", action='store_true', help="store the results as the baseline")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    config = {'repo': {'commits': args.commits, 'files': args.files, 'churn': args.churn,
+                       'fix_rate': args.fix_rate, 'seed': args.seed},
+              'repeat': args.repeat, 'gumtree_pairs': args.gumtree_pairs, 'backend': args.backend,
+              'workers': args.workers}
+    root = args.work_dir or tempfile.mkdtemp(prefix='apachejit-bench-')
+    root = os.path.abspath(root)
+    prepare(root, config)
+    results = dict()
+    for name in args.stages:
+        runs = [run_stage(name, root, config) for _ in range(args.runs)]
+        timed = [r for r in runs if 'seconds' in r]
+        # the fastest run is the least disturbed by the rest of the machine
+        results[name] = min(timed, key=lambda r: r['seconds']) if len(timed) == len(runs) else runs[-1]
+    if not args.work_dir:
+        shutil.rmtree(root, ignore_errors=True)
+
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            stored = json.load(file)
+        if stored.get('config') == config:
+            baseline = stored['results']
+        else:
+            print('baseline was recorded with another configuration, not compared.')
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({'config': config,
+                       'results': dict(baseline, **{k: v for k, v in results.items() if 'seconds' in v})},
+                      file, indent=1)
+        print('baseline saved to {}'.format(args.baseline))
+    failed = [name for name, result in results.items() if 'failed' in result]
+    if regressions:
+        print('slower than the baseline: {}'.format(', '.join(regressions)))
+    if regressions or failed:
+        sys.exit(1)
@@ -0,0 +1,197 @@
+"""
+Offline check of AsyncGithubCollector against a local stub of the GitHub commit search API.
+
+    python benchmarks/stub_github.py                  # all scenarios
+    python benchmarks/stub_github.py --keys 200 --tokens 3
+
+The stub answers `/search/commits?q=repo:<repo>+"<key>"` from a fixed set of links and enforces a per token
+quota. Scenarios: the quota reported in X-RateLimit-* headers, no rate limit headers at all, and transient
+502 responses. Each checks the links written by the collector and that no token was used past its quota.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, 'src'))
+
+PROJECT = 'STUB'
+REPOS = ['apache/stub', 'apache/stub-old']
+QUERY = re.compile('^repo:(\\S+) "(.+)"$')
+
+
+class StubGithub(ThreadingHTTPServer):
+    """
+    commit search with a quota of `quota` requests per `window` seconds and token
+    """
+    daemon_threads = True
+
+    def __init__(self, links, quota, window, headers=True, flaky=(), delay=0.02):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.links = links
+        self.quota = quota
+        self.window = window
+        self.headers = headers
+        self.flaky = set(flaky)  # keys whose first request fails with a 502
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.windows = dict()  # token -> [reset, used]
+        self.in_flight = dict()
+        self.max_in_flight = dict()
+        self.over_quota = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def charge(self, token):
+        """
+        :return: (allowed, remaining, reset) of a request with the token
+        """
+        with self.lock:
+            now = time.time()
+            reset, used = self.windows.get(token, (0, 0))
+            if now >= reset:
+                reset, used = now + self.window, 0
+            allowed = used < self.quota
+            used += 1 if allowed else 0
+            self.windows[token] = (reset, used)
+            self.requests += 1
+            self.over_quota += 0 if allowed else 1
+            if allowed:
+                self.in_flight[token] = self.in_flight.get(token, 0) + 1
+                self.max_in_flight[token] = max(self.max_in_flight.get(token, 0), self.in_flight[token])
+            return allowed, self.quota - used, reset
+
+    def done(self, token):
+        with self.lock:
+            self.in_flight[token] -= 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stub = self.server
+        token = self.headers.get('authorization', '').split()[-1]
+        allowed, remaining, reset = stub.charge(token)
+        headers = {'X-RateLimit-Limit': stub.quota, 'X-RateLimit-Remaining': remaining,
+                   'X-RateLimit-Reset': int(reset) + 1} if stub.headers else dict()
+        if not allowed:
+            return self.reply(403, {'message': 'API rate limit exceeded'}, headers)
+        try:
+            time.sleep(stub.delay)
+            match = QUERY.match(parse_qs(urlsplit(self.path).query)['q'][0])
+            repo, key = match.group(1), match.group(2)
+            with stub.lock:
+                flaky = key in stub.flaky
+                stub.flaky.discard(key)
+            if flaky:
+                return self.reply(502, {'message': 'Server Error'}, headers)
+            sha = stub.links.get((repo, key))
+            self.reply(200, {'items': [{'sha': sha}] if sha is not None else []}, headers)
+        finally:
+            stub.done(token)
+
+    def reply(self, status, body, headers):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_links(n):
+    """
+    issue keys and their links: a third only in the first repo, a third only in the second, a third in none
+    """
+    keys = ['{}-{}'.format(PROJECT, i) for i in range(1, n + 1)]
+    links = dict()
+    for i, k in enumerate(keys):
+        if i % 3 < 2:
+            links[(REPOS[i % 3], k)] = '{:040x}'.format(i)
+    return keys, links
+
+
+def write_tokens(path, n):
+    now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
+    with open(path, 'w') as file:
+        json.dump([{'token': 'stub{}'.format(i), 'last_use_time': now, 'next_use_time': now} for i in range(n)],
+                  file)
+
+
+def run_scenario(name, root, keys, links, concurrency, **stub_options):
+    import collector
+    from async_collector import AsyncGithubCollector
+    stub = StubGithub(links, **stub_options).start()
+    collector.data_path = os.path.join(root, name)
+    os.makedirs(collector.data_path)
+    github = AsyncGithubCollector(base_url=stub.url, concurrency=concurrency)
+    github.proj_repo = {PROJECT: REPOS}
+    start = time.time()
+    github.start(keys, PROJECT)
+    elapsed = time.time() - start
+    stub.shutdown()
+
+    expected = {k: links.get((REPOS[0], k), links.get((REPOS[1], k))) for k in keys}
+    expected = {k: sha for k, sha in expected.items() if sha is not None}
+    with open(os.path.join(collector.data_path, '{}.csv'.format(PROJECT.lower()))) as file:
+        found = dict(line.strip().split(',') for line in file.readlines()[1:])
+    errors = []
+    if found != expected:
+        errors.append('{} links differ from the stub'.format(len(set(found.items()) ^ set(expected.items()))))
+    if stub.over_quota:
+        errors.append('{} requests over the quota'.format(stub.over_quota))
+    if max(stub.max_in_flight.values()) < 2:
+        errors.append('no token had concurrent requests')
+    print('{}: {} searches in {:.1f} sec, {} requests, {} over quota, max {} in flight per token{}'
+          .format(name, len(keys), elapsed, stub.requests, stub.over_quota, max(stub.max_in_flight.values()),
+                  ''.join('\n\tFAILED: ' + e for e in errors)))
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", default=90, type=int, help="issue keys searched")
+    parser.add_argument("--tokens", default=2, type=int)
+    parser.add_argument("--concurrency", default=8, type=int)
+    parser.add_argument("--quota", default=20, type=int, help="requests per token and window of the stub")
+    parser.add_argument("--window", default=3, type=int, help="seconds of the stub's quota window")
+    args = parser.parse_args()
+
+    from git_token import Token
+    keys, links = make_links(args.keys)
+    with tempfile.TemporaryDirectory(prefix='stub-github-') as root:
+        os.chdir(root)
+        Token.TOKEN_FILE_NAME = os.path.join(root, 'token.json')
+        write_tokens(Token.TOKEN_FILE_NAME, args.tokens)
+        run = dict(root=root, keys=keys, links=links, concurrency=args.concurrency)
+        ok = [run_scenario('rate_limit_headers', quota=args.quota, window=args.window, **run),
+              # the collector assumes the documented 30 requests per minute, the stub enforces the same.
+              # a key takes 5/3 searches on average, so these fit in one window
+              run_scenario('no_headers', quota=30, window=60, headers=False,
+                           **dict(run, keys=keys[:15 * args.tokens])),
+              run_scenario('server_errors', quota=args.quota, window=args.window, flaky=keys[::10], **run)]
+    sys.exit(0 if all(ok) else 1)
+
+
+if __name__ == '__main__':
+    main()
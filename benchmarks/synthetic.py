@@ -0,0 +1,110 @@
+import os
+import random
+import subprocess
+
+PROJECT = 'SYN'
+REPO_NAME = 'synthetic'
+START_DATE = 1104537600  # Jan 1, 2005, inside GitMiner.CLEAN_SINCE..CLEAN_TO
+AUTHORS = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank']
+IDENTIFIERS = ['count', 'index', 'value', 'buffer', 'result', 'name', 'size', 'offset', 'total', 'item']
+
+
+def java_line(rng):
+    a, b = rng.sample(IDENTIFIERS, 2)
+    return '        {} = {} + {};'.format(a, b, rng.randrange(1000))
+
+
+def java_file(name, lines):
+    body = '\n'.join(lines)
+    return 'package org.apache.synthetic;\n\npublic class {} {{\n    public void run() {{\n{}\n    }}\n}}\n' \
+        .format(name, body)
+
+
+def make_repo(path, commits=500, files=50, churn=3, fix_rate=0.2, seed=0):
+    """
+    builds a deterministic git repo with `git fast-import`: java files whose lines are changed by `churn`
+    files per commit, a share of `fix_rate` commits named like `SYN-<n> fix` that rewrite existing lines
+    (so SZZ finds their bug-inducing commits), an occasional non-java file and a few large commits.
+    the same arguments always give the same commit hashes.
+
+    :return: list of (hash, is_fix) in commit order
+    """
+    rng = random.Random(seed)
+    contents = {'src/main/java/org/apache/synthetic/C{}.java'.format(i): [java_line(rng) for _ in range(20)]
+                for i in range(files)}
+    stream = []
+
+    def data(text):
+        raw = text.encode('utf-8')
+        stream.append(b'data ' + str(len(raw)).encode() + b'\n' + raw + b'\n')
+
+    issue = 0
+    date = START_DATE
+    step = 10 * 365 * 86400 // max(commits, 1)  # the history spans about ten years
+    for n in range(commits):
+        date += rng.randint(1, 2 * step)
+        author = rng.choice(AUTHORS)
+        is_fix = n > 0 and rng.random() < fix_rate
+        if is_fix:
+            issue += 1
+            message = '{}-{} fix {}'.format(PROJECT, issue, rng.choice(IDENTIFIERS))
+        else:
+            message = 'change {}'.format(n)
+        stream.append('commit refs/heads/master\nmark :{}\nauthor {} <{}@example.org> {} +0000\n'
+                      'committer {} <{}@example.org> {} +0000\n'
+                      .format(n + 1, author, author, date, author, author, date).encode())
+        data(message)
+        if n > 0:
+            stream.append('from :{}\n'.format(n).encode())
+        changed = list(contents) if n == 0 else rng.sample(sorted(contents), min(churn, files))
+        if n > 0 and rng.random() < 0.02:  # a large commit, dropped by the line filter
+            changed = sorted(contents)
+        for filename in changed:
+            lines = contents[filename]
+            if n > 0:
+                for _ in range(rng.randint(1, 4)):
+                    lines[rng.randrange(len(lines))] = java_line(rng)
+                if not is_fix:
+                    lines.insert(rng.randrange(len(lines) + 1), java_line(rng))
+            stream.append('M 100644 inline {}\n'.format(filename).encode())
+            data(java_file(os.path.basename(filename)[:-len('.java')], lines))
+        if rng.random() < 0.05:
+            stream.append(b'M 100644 inline README.md\n')
+            data('synthetic repo, commit {}\n'.format(n))
+
+    os.makedirs(path, exist_ok=True)
+    git = ['git', '-C', path]
+    subprocess.run(git + ['init', '-q'], check=True)
+    subprocess.run(git + ['fast-import', '--quiet'], input=b''.join(stream), check=True)
+    subprocess.run(git + ['symbolic-ref', 'HEAD', 'refs/heads/master'], check=True)
+    subprocess.run(git + ['reset', '-q', '--hard'], check=True)
+    out = subprocess.run(git + ['log', '--reverse', '--format=%H %s', 'HEAD'], stdout=subprocess.PIPE,
+                         check=True, universal_newlines=True).stdout
+    return [(line.split(' ', 1)[0], line.split(' ', 1)[1].startswith(PROJECT + '-')) for line in out.splitlines()]
+
+
+def make_dot(nodes, red_rate=0.1, seed=0):
+    """
+    a GumTree dotdiff output with a random tree of `nodes` nodes on each side, red nodes come in
+    small subtrees like the changed statements of a real diff
+    """
+    rng = random.Random(seed)
+    lines = ['digraph G {', 'node [style=filled];']
+    for side, header in ((0, 'subgraph cluster_src {'), (1, 'subgraph cluster_dst\xa0 {')):
+        # the dst header uses the same non-breaking space GumTreeDiff.get_dotfiles matches on
+        lines.append(header)
+        parents = [None] + [rng.randrange(i) for i in range(1, nodes)]
+        red = set()
+        for i in range(nodes):
+            if rng.random() < red_rate / 4 or (parents[i] in red and rng.random() < 0.5):
+                red.add(i)
+        for i in range(nodes):
+            start = rng.randrange(10000)
+            lines.append('n_{}_{} [label="{}: {} [{},{}]", color={}];'.format(
+                side, i, rng.choice(['SimpleName', 'MethodInvocation', 'Assignment', 'Block']),
+                rng.choice(IDENTIFIERS), start, start + rng.randrange(1, 50), 'red' if i in red else 'blue'))
+        for i in range(1, nodes):
+            lines.append('n_{}_{} -> n_{}_{};'.format(side, parents[i], side, i))
+        lines.append('}')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
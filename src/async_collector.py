@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from datetime import datetime
+
+import aiohttp
+
+from collector import GithubCollector, read_issue_keys
+from git_token import Token
+import instrumentation
+from instrumentation import count, observe
+
+# documented quota of the search API, assumed for responses without X-RateLimit-* headers
+SEARCH_QUOTA = 30
+SEARCH_WINDOW = 60
+
+
+class TokenState(object):
+    """
+    Search quota of one token as reported by the X-RateLimit-* headers of its last response.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.remaining = None  # unknown until the first response
+        self.reset = 0.0
+        self.in_flight = 0
+
+    def quota(self, now):
+        if self.remaining is None or now >= self.reset:  # unknown or already refilled
+            return float('inf')
+        return self.remaining - self.in_flight
+
+    def available(self, now, reserve):
+        if self.remaining is None:  # probe the quota with a single request first
+            return self.in_flight == 0
+        return self.quota(now) > reserve
+
+
+class TokenPool(object):
+    """
+    Hands out the token with the most remaining quota, waits for a request to finish when the quota left
+    is held by requests in flight and sleeps until the earliest reset when all tokens are exhausted.
+    Quotas come from the response headers, no extra rate limit calls are made.
+    """
+
+    def __init__(self, token_list, reserve=0):
+        self.states = [TokenState(t) for t in token_list]
+        self.reserve = reserve
+        self.waited = 0.0
+        self.released = None  # created in the event loop of the first acquire
+
+    async def acquire(self):
+        while True:
+            now = time.time()
+            candidates = [s for s in self.states if s.available(now, self.reserve)]
+            if candidates:
+                state = max(candidates, key=lambda s: s.quota(now))
+                state.in_flight += 1
+                return state
+            wait = max(min(s.reset for s in self.states) - now, 0) + random.uniform(0.5, 1.5)
+            if any(s.in_flight for s in self.states):  # a response can free a token before the reset
+                if self.released is None:
+                    self.released = asyncio.Event()
+                self.released.clear()
+                try:
+                    await asyncio.wait_for(self.released.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logging.info("All tokens exhausted, waiting {:.1f} sec".format(wait))
+            self.waited += wait
+            observe('token_wait', wait)
+            await asyncio.sleep(wait)
+
+    def release(self, state, status=None, headers=None):
+        state.in_flight -= 1
+        if self.released is not None:
+            self.released.set()
+        if headers is None:
+            return
+        now = time.time()
+        if 'X-RateLimit-Remaining' in headers:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = float(headers.get('X-RateLimit-Reset', now + SEARCH_WINDOW))
+            # responses finish out of order, one of an earlier window or an earlier request of this one is stale
+            if state.remaining is None or reset > state.reset:
+                state.remaining, state.reset = remaining, reset
+            elif reset == state.reset:
+                state.remaining = min(state.remaining, remaining)
+        elif state.remaining is None or now >= state.reset:  # no headers, count against the documented quota
+            state.remaining, state.reset = SEARCH_QUOTA - 1, now + SEARCH_WINDOW
+        else:
+            state.remaining = max(state.remaining - 1, 0)
+        if 'Retry-After' in headers:  # secondary rate limit
+            state.remaining = 0
+            state.reset = now + float(headers['Retry-After'])
+        elif status == 403 and 'X-RateLimit-Remaining' not in headers:
+            state.remaining, state.reset = 0, now + SEARCH_WINDOW
+        state.token.last_use_time = datetime.utcnow()
+        if state.remaining == 0:
+            state.token.next_use_time = datetime.utcfromtimestamp(state.reset)
+
+
+class AsyncGithubCollector(GithubCollector):
+    """
+    GithubCollector that runs many searches concurrently over all tokens of config/token.json
+    and retries 403/429/5xx responses with exponential backoff and jitter.
+    """
+
+    def __init__(self, base_url='https://api.github.com', concurrency=16, max_backoff=300, cache_path=None):
+        super().__init__(cache_path)
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.max_backoff = max_backoff
+        self.pool = TokenPool(self.token_list)
+
+    async def fetch(self, session, url, entry=None):
+        """
+        :param entry: cached response of the url, revalidated with If-None-Match
+        :return: (status, headers, body) of a GET with one of the pool's tokens, the body is None
+        for a 304 that has no entry to revalidate
+        """
+        state = await self.pool.acquire()
+        headers = {'authorization': 'token {}'.format(state.token.token),
+                   'content-type': 'application/json',
+                   'accept': 'application/vnd.github.cloak-preview'}
+        if self.cache is not None:
+            headers = self.cache.conditional_headers(entry, headers)
+        # concurrent requests interleave on one thread, so they are observed rather than timed
+        start = time.perf_counter()
+        try:
+            async with session.get(url, headers=headers) as response:
+                body = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.pool.release(state)
+            count('http_errors')
+            raise
+        finally:
+            observe('http', time.perf_counter() - start)
+        self.pool.release(state, response.status, response.headers)
+        status = response.status
+        if self.cache is not None:
+            body = self.cache.update(url, status, body, response.headers.get('ETag'), entry)
+            status = 200 if status == 304 and body is not None else status
+        return status, response.headers, body
+
+    async def search(self, session, repo, key):
+        url = '{}/search/commits?q=repo:{}+"{}"'.format(self.base_url, repo, key)
+        entry = self.cache.lookup(url) if self.cache is not None else None
+        body = self.cache.fresh_body(entry) if self.cache is not None else None
+        if body is not None:
+            return json.loads(body)['items']
+        attempt = 0
+        while True:
+            try:
+                status, _, body = await self.fetch(session, url, entry)
+                if body is None:  # nothing to revalidate against, ask again unconditionally
+                    entry = None
+                    continue
+                if status == 200:
+                    return json.loads(body)['items']
+                if status not in (403, 429) and status < 500:
+                    logging.warning("{} for {}: {}".format(status, url, body[:200]))
+                    return []
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                logging.warning("Request for {} failed: {}".format(url, e))
+            attempt += 1
+            await asyncio.sleep(min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.5))
+
+    async def link(self, session, key):
+        for r in self.proj_repo[self.project]:
+            items = await self.search(session, r, key)
+            if len(items) > 0:
+                self.found[key] = items[0]['sha']
+                return
+        self.notfound.append(key)
+
+    async def run(self, issue_keys):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        count = 0
+
+        async def bounded(session, key):
+            nonlocal count
+            async with semaphore:
+                await self.link(session, key)
+            count += 1
+            logging.info("Completed {:.2f} %".format((count / len(issue_keys)) * 100))
+            if count % self.dump_rate == 0:
+                self.dump_data()
+                self.notfound = []
+
+        timeout = aiohttp.ClientTimeout(total=60)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*(bounded(session, k) for k in issue_keys))
+
+    def start(self, issue_keys, project):
+        self.project = project
+        issue_keys = list(issue_keys)
+        asyncio.run(self.run(issue_keys))
+        # searches finish out of order, keep the links in issue key order like the serial collector
+        self.found = {k: self.found[k] for k in issue_keys if k in self.found}
+        self.dump_data()
+        logging.info("Waited {:.1f} sec for token resets".format(self.pool.waited))
+        Token.dump_all_token(self.token_list)
+        if self.cache is not None:
+            logging.info('response cache: {}'.format(self.cache.stats()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", default=None, type=str, help="")
+    parser.add_argument("--concurrency", default=16, type=int, help="number of concurrent searches")
+    parser.add_argument("--base-url", default='https://api.github.com', type=str, help="GitHub API root")
+    parser.add_argument("--cache", default=None, type=str, help="path of the search response cache")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+
+    issue_keys = read_issue_keys(args.project)
+
+    github = AsyncGithubCollector(base_url=args.base_url, concurrency=args.concurrency, cache_path=args.cache)
+    github.start(issue_keys, args.project)
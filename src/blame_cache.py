@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+
+from pydriller import Git
+
+from instrumentation import count
+from lru_store import LRUStore
+
+
+class BlameCache(LRUStore):
+    """
+    Persistent cache of `git blame` results keyed by (repo, revision, path, blame options).
+    Only the blamed commit of every line is kept, which is all SZZ reads from the blame output.
+    """
+
+    @staticmethod
+    def make_key(repo, rev, path, options):
+        # repos are identified by their real path so that HDFS and MAPREDUCE share apache/hadoop entries
+        raw = '\0'.join([os.path.realpath(repo), rev, path, *options])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get_blame(self, repo, rev, path, options):
+        value = self.get(self.make_key(repo, rev, path, options))
+        return None if value is None else json.loads(value)
+
+    def put_blame(self, repo, rev, path, options, line_commits):
+        self.put(self.make_key(repo, rev, path, options), json.dumps(line_commits).encode('utf-8'))
+
+
+class CachedGit(Git):
+    """
+    PyDriller Git handle that serves the blames of get_commits_last_modified_lines from a BlameCache.
+    """
+
+    def __init__(self, path, cache, conf=None):
+        super().__init__(path, conf)
+        self.cache = cache
+
+    def _get_blame(self, commit_hash, path, hashes_to_ignore_path=None):
+        options = ['-w']
+        if hashes_to_ignore_path is not None:
+            with open(hashes_to_ignore_path, 'rb') as file:
+                options.append('ignore-revs:' + hashlib.sha1(file.read()).hexdigest())
+        rev = commit_hash + '^'
+        line_commits = self.cache.get_blame(str(self.path), rev, path, options)
+        count('blame_cache_miss' if line_commits is None else 'blame_cache_hit')
+        if line_commits is None:
+            lines = super()._get_blame(commit_hash, path, hashes_to_ignore_path)
+            # szz only uses the first token of each blame line (the possibly abbreviated commit hash)
+            line_commits = [line.split(' ')[0] for line in lines]
+            self.cache.put_blame(str(self.path), rev, path, options, line_commits)
+        return line_commits
@@ -7,6 +7,10 @@ import requests
 from github import Github
 import pandas as pd
 from git_token import Token
+from http_cache import ResponseCache
+from work_queue import WorkQueue
+import instrumentation
+from instrumentation import count, timer
 import logging
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
@@ -16,20 +20,44 @@ BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 data_path = os.path.join(BASE_DIR, 'data')
 
 
+def dump_data(project, found, notfound, found_file=None):
+    """
+    writes the found links of a project to `<project>.csv` and appends its notfound keys to notfound.csv
+    :param found_file: name of the found file in data/ instead of `<project>.csv`
+    """
+    f_file = os.path.join(data_path, found_file or '{}.csv'.format(project.lower()))
+    df = pd.DataFrame(found.items(), columns=['issue_key', 'commit_id'])
+    df.to_csv(f_file, index=False)
+    n_file = os.path.join(data_path, 'notfound.csv')
+    if os.path.isfile(n_file):
+        df_prev = pd.read_csv(n_file)
+    else:
+        df_prev = pd.DataFrame(columns=['project', 'issue_key'])
+    df_new = pd.DataFrame({'project': project.lower(), 'issue_key': notfound})
+    df = pd.concat([df_prev, df_new])
+    df.to_csv(n_file, index=False)
+
+
 class GithubCollector(object):
+    PROJ_REPO = {'MESOS': ['apache/mesos'], 'AMQ': ['apache/activemq'], 'HBASE': ['apache/hbase'],
+                 'SPARK': ['apache/spark'], 'KAFKA': ['apache/kafka'], 'GROOVY': ['apache/groovy'],
+                 'ZEPPELIN': ['apache/zeppelin'], 'HDFS': ['apache/hadoop-hdfs', 'apache/hadoop'],
+                 'FLINK': ['apache/flink'], 'ROCKETMQ': ['apache/rocketmq'], 'CAMEL': ['apache/camel'],
+                 'MAPREDUCE': ['apache/hadoop-mapreduce', 'apache/hadoop'], 'IGNITE': ['apache/ignite'],
+                 'CASSANDRA': ['apache/cassandra'], 'HIVE': ['apache/hive'], 'ZOOKEEPER': ['apache/zookeeper']}
 
-    def __init__(self):
+    def __init__(self, cache_path=None):
+        """
+        :param cache_path: optional ResponseCache database, lets an interrupted run resume from cached searches
+        """
+        self.cache = ResponseCache(cache_path) if cache_path is not None else None
         self.token_list = Token.get_token_list()
         self.github = Github(self.token_list[0].token)
         self.session = requests.Session()
-        self.proj_repo = {'MESOS': ['apache/mesos'], 'AMQ': ['apache/activemq'], 'HBASE': ['apache/hbase'],
-                          'SPARK': ['apache/spark'], 'KAFKA': ['apache/kafka'], 'GROOVY': ['apache/groovy'],
-                          'ZEPPELIN': ['apache/zeppelin'], 'HDFS': ['apache/hadoop-hdfs', 'apache/hadoop'],
-                          'FLINK': ['apache/flink'], 'ROCKETMQ': ['apache/rocketmq'], 'CAMEL': ['apache/camel'],
-                          'MAPREDUCE': ['apache/hadoop-mapreduce', 'apache/hadoop'], 'IGNITE': ['apache/ignite'],
-                          'CASSANDRA': ['apache/cassandra'], 'HIVE': ['apache/hive'], 'ZOOKEEPER': ['apache/zookeeper']}
+        self.proj_repo = self.PROJ_REPO
         self.found = {}
         self.notfound = []
+        self.found_file = None
         self.dump_rate = 500
         Path("logs/").mkdir(parents=True, exist_ok=True)
         logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
@@ -39,41 +67,16 @@ class GithubCollector(object):
                                                     backupCount=5)])
 
     def dump_data(self):
-        f_file = os.path.join(data_path, '{}.csv'.format(self.project.lower()))
-        df = pd.DataFrame(self.found.items(), columns=['issue_key', 'commit_id'])
-        df.to_csv(f_file, index=False)
-        n_file = os.path.join(data_path, 'notfound.csv')
-        if os.path.isfile(n_file):
-            df_prev = pd.read_csv(n_file)
-        else:
-            df_prev = pd.DataFrame(columns=['project', 'issue_key'])
-        df_new = pd.DataFrame({'project': self.project.lower(), 'issue_key': self.notfound})
-        df = pd.concat([df_prev, df_new])
-        df.to_csv(n_file, index=False)
+        dump_data(self.project, self.found, self.notfound, self.found_file)
 
     def start(self, issue_keys, project):
         self.project = project
-        repos = self.proj_repo[project]
         count = 0
         for k in issue_keys:
-            for r in repos:
-                Token.update_token(self.github, token_list=self.token_list)
-                headers = {'authorization': '{}'.format(self.github._Github__requester._Requester__authorizationHeader),
-                           'content-type': 'application/json',
-                           'accept': 'application/vnd.github.cloak-preview'}
-                url = 'https://api.github.com/search/commits?q=repo:{}+"{}"'.format(r, k)
-                while True:
-                    try:
-                        response = self.session.get(url, headers=headers)
-                        response_dict = json.loads(response.text)
-                        items = response_dict['items']
-                        break
-                    except:
-                        time.sleep(30)
-                if len(items) > 0:
-                    self.found[k] = items[0]['sha']
-                    break
-            if k not in self.found:
+            sha = self.find(k)
+            if sha is not None:
+                self.found[k] = sha
+            else:
                 self.notfound.append(k)
             count += 1
             logging.info("Completed {:.2f} %".format((count / len(issue_keys)) * 100))
@@ -82,14 +85,70 @@ class GithubCollector(object):
                 self.notfound = []
         self.dump_data()
         Token.dump_all_token(self.token_list)
+        if self.cache is not None:
+            logging.info('response cache: {}'.format(self.cache.stats()))
 
+    def find(self, key):
+        """
+        :return: sha of the first commit of the project's repos that mentions the issue key, or None
+        """
+        for r in self.proj_repo[self.project]:
+            url = 'https://api.github.com/search/commits?q=repo:{}+"{}"'.format(r, key)
+            entry = self.cache.lookup(url) if self.cache is not None else None
+            body = self.cache.fresh_body(entry) if self.cache is not None else None
+            items = json.loads(body)['items'] if body is not None else self.search(url, entry)
+            if len(items) > 0:
+                return items[0]['sha']
+        return None
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--project", default=None, type=str, help="")
-    args = parser.parse_args()
-    project = args.project
+    def start_queue(self, issue_keys, project, queue_path, batch=20):
+        """
+        start over a WorkQueue: collectors on this host with their own tokens can split the issue keys, and
+        a restarted collector skips the keys that are done. the one that finds the queue drained dumps the data.
+        """
+        self.project = project
+        queue = WorkQueue(queue_path, 'search/{}'.format(project))
+        queue.add((k, None) for k in issue_keys)
+        queue.run(lambda k, _: self.find(k), batch)
+        Token.dump_all_token(self.token_list)
+        if queue.try_finalize():
+            for k, _, sha in queue.results():
+                if sha is not None:
+                    self.found[k] = sha
+                else:
+                    self.notfound.append(k)
+            self.dump_data()
+            queue.finish_finalize()
+        queue.close()
+
+    def search(self, url, entry=None):
+        """
+        :param entry: cached response of the url, revalidated with If-None-Match
+        """
+        with timer('token_wait'):
+            Token.update_token(self.github, token_list=self.token_list)
+        headers = {'authorization': '{}'.format(self.github._Github__requester._Requester__authorizationHeader),
+                   'content-type': 'application/json',
+                   'accept': 'application/vnd.github.cloak-preview'}
+        while True:
+            try:
+                request_headers = self.cache.conditional_headers(entry, headers) if self.cache is not None else headers
+                with timer('http'):
+                    response = self.session.get(url, headers=request_headers)
+                body = response.text
+                if self.cache is not None:
+                    body = self.cache.update(url, response.status_code, body, response.headers.get('ETag'), entry)
+                    if body is None:  # nothing to revalidate against, ask again unconditionally
+                        entry = None
+                        continue
+                response_dict = json.loads(body)
+                return response_dict['items']
+            except:
+                count('http_errors')
+                time.sleep(30)
 
+
+def read_issue_keys(project):
     years = ['2010', '2011', '2012', '2013', '2014', '2015', '2016', '2017', '2018', '2019']
     dfs = []
     for y in years:
@@ -99,8 +158,24 @@ if __name__ == "__main__":
     df = pd.concat(dfs, axis=0, ignore_index=True)
     df.drop_duplicates(subset=['Issue key'])
 
-    issue_keys = df[df['Issue key'].str.split('-').str[0] == project]['Issue key']
+    return df[df['Issue key'].str.split('-').str[0] == project]['Issue key']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", default=None, type=str, help="")
+    parser.add_argument("--cache", default=None, type=str, help="path of the search response cache")
+    parser.add_argument("--queue", default=None, type=str, help="work queue database shared by the collectors of this host, on a local disk")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    project = args.project
+
+    issue_keys = read_issue_keys(project)
 
-    github = GithubCollector()
-    github.start(issue_keys, project)
+    github = GithubCollector(cache_path=args.cache)
+    if args.queue is not None:
+        github.start_queue(issue_keys, project, args.queue)
+    else:
+        github.start(issue_keys, project)
     
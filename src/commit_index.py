@@ -0,0 +1,153 @@
+import gzip
+import logging
+import os
+import socket
+import struct
+import subprocess
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+index_path = os.path.join(BASE_DIR, 'cache', 'commits')
+
+
+class CommitIndex:
+    """
+    hash -> (committer_date, author_date, author, parents) for every commit of a repo.
+    The index is built with a single streamed `git log` and stored as a gzipped binary file
+    next to the tips it was built from, so later updates only read the new commits.
+    Hashes that are not reachable from any ref are resolved through one `git cat-file --batch` process.
+    """
+    MAGIC = b'CIDX1'
+    LOG_FORMAT = '%H%x00%ct%x00%at%x00%an%x00%P'
+
+    def __init__(self, repo, index_file=None, update=True):
+        self.repo = repo
+        self.index_file = index_file or os.path.join(index_path, os.path.basename(os.path.normpath(repo)) + '.idx')
+        self.commits = {}
+        self.tips = []
+        self.cat_file = None
+        if os.path.isfile(self.index_file):
+            self.load()
+        if update:
+            self.update()
+
+    def git(self, *args, **kwargs):
+        return subprocess.run(['git', '-C', self.repo, *args], stdout=subprocess.PIPE,
+                              universal_newlines=True, check=True, **kwargs).stdout
+
+    def current_tips(self):
+        return sorted(set(self.git('rev-parse', 'HEAD', '--all').split()))
+
+    def update(self):
+        tips = self.current_tips()
+        if tips == self.tips:
+            return 0
+        # everything reachable from the current refs that was not reachable from the indexed tips
+        exclude = ''.join('^{}\n'.format(t) for t in self.tips)
+        try:
+            out = self.git('log', '--all', 'HEAD', '--stdin', '--format=' + self.LOG_FORMAT, input=exclude)
+        except subprocess.CalledProcessError:  # indexed tips are gone (rewritten history), start over
+            self.commits = {}
+            out = self.git('log', '--all', 'HEAD', '--format=' + self.LOG_FORMAT)
+        added = 0
+        for line in out.splitlines():
+            h, ct, at, author, parents = line.split('\0')
+            if h not in self.commits:
+                added += 1
+            self.commits[h] = (int(ct), int(at), author, tuple(parents.split()))
+        self.tips = tips
+        self.save()
+        logging.info('commit index of {}: {} new commits, {} in total'.format(self.repo, added, len(self.commits)))
+        return added
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        authors = {}
+        records = []
+        for h, (ct, at, author, parents) in self.commits.items():
+            a = authors.setdefault(author, len(authors))
+            records.append(struct.pack('<20sqqIB', bytes.fromhex(h), ct, at, a, len(parents)) +
+                           b''.join(bytes.fromhex(p) for p in parents))
+        names = '\n'.join(authors).encode('utf-8')
+        # hosts sharing the cache directory can save at the same time, each writes its own file
+        tmp = '{}.{}.{}.tmp'.format(self.index_file, socket.gethostname(), os.getpid())
+        with gzip.open(tmp, 'wb') as file:
+            file.write(self.MAGIC)
+            file.write(struct.pack('<III', len(self.tips), len(names), len(records)))
+            file.write(b''.join(bytes.fromhex(t) for t in self.tips))
+            file.write(names)
+            file.write(b''.join(records))
+        os.replace(tmp, self.index_file)
+
+    def load(self):
+        with gzip.open(self.index_file, 'rb') as file:
+            data = file.read()
+        if not data.startswith(self.MAGIC):
+            raise ValueError('{} is not a commit index'.format(self.index_file))
+        pos = len(self.MAGIC)
+        n_tips, names_len, n_records = struct.unpack_from('<III', data, pos)
+        pos += 12
+        self.tips = [data[pos + 20 * i:pos + 20 * (i + 1)].hex() for i in range(n_tips)]
+        pos += 20 * n_tips
+        authors = data[pos:pos + names_len].decode('utf-8').split('\n')
+        pos += names_len
+        record = struct.Struct('<20sqqIB')
+        for _ in range(n_records):
+            h, ct, at, a, n_parents = record.unpack_from(data, pos)
+            pos += record.size
+            parents = tuple(data[pos + 20 * i:pos + 20 * (i + 1)].hex() for i in range(n_parents))
+            pos += 20 * n_parents
+            self.commits[h.hex()] = (ct, at, authors[a], parents)
+
+    def read_object(self, h):
+        if self.cat_file is None:
+            self.cat_file = subprocess.Popen(['git', '-C', self.repo, 'cat-file', '--batch'],
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.cat_file.stdin.write((h + '\n').encode())
+        self.cat_file.stdin.flush()
+        header = self.cat_file.stdout.readline().decode().split()
+        if len(header) != 3:  # `<hash> missing`
+            return None
+        body = self.cat_file.stdout.read(int(header[2]) + 1).decode('utf-8', errors='replace')
+        if header[1] != 'commit':
+            return None
+        ct, at, author, parents = 0, 0, '', []
+        for line in body.split('\n\n', 1)[0].splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'parent':
+                parents.append(value)
+            elif key == 'author':
+                author = value.rsplit(' <', 1)[0]
+                at = int(value.split()[-2])
+            elif key == 'committer':
+                ct = int(value.split()[-2])
+        return ct, at, author, tuple(parents)
+
+    def lookup(self, hashes):
+        """
+        batched lookup, returns a dict with an entry for every hash that exists in the repo
+        """
+        found = {}
+        for h in hashes:
+            meta = self.commits.get(h)
+            if meta is None:
+                meta = self.read_object(h)
+                if meta is None:
+                    continue
+                self.commits[h] = meta
+            found[h] = meta
+        return found
+
+    def get(self, h):
+        return self.lookup([h]).get(h)
+
+    def committer_date(self, h):
+        return self.get(h)[0]
+
+    def author_date(self, h):
+        return self.get(h)[1]
+
+    def close(self):
+        if self.cat_file is not None:
+            self.cat_file.stdin.close()
+            self.cat_file.wait()
+            self.cat_file = None
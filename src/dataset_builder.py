@@ -0,0 +1,212 @@
+import argparse
+import logging
+import os
+import tempfile
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from jit_dataset import export_dataset
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+data_path = os.path.join(BASE_DIR, 'data')
+dataset_path = os.path.join(BASE_DIR, 'dataset')
+build_path = os.path.join(BASE_DIR, 'build', 'dataset')
+
+SPLITS = ['total', 'train', 'test_large', 'test_small']
+STRATA_SIZE = 60 * 60 * 24 * 365.25  # one stratum per year
+MIN_DATE = 1041397200  # Jan 1, 2003
+FIRST_YEAR = 2003
+LAST_YEAR = 2019
+TEST_STRATUM = 14  # 2017 onwards is the test period
+TEST_SMALL_FRAC = 0.25
+COMMIT_COLUMNS = ['commit_id', 'project', 'buggy', 'fix', 'year']
+METRIC_DTYPES = {'commit_id': str, 'author_date': np.int64, 'la': np.int64, 'ld': np.int64, 'nf': np.int64,
+                 'nd': np.int64, 'ns': np.int64, 'ent': np.float64, 'ndev': np.float64, 'age': np.float64,
+                 'nuc': np.float64, 'aexp': np.int64, 'arexp': np.float64, 'asexp': np.float64}
+
+
+class DatasetBuilder:
+    """
+    dataset_construction.ipynb as a module: labels the filtered buggy, fix and clean commits with their
+    year strata, splits them into train and test periods, balances the train set with a stratified sample
+    of the clean commits and writes the four apachejit splits with the Kamei metrics.
+    Commits are ordered by hash before any random draw, so the splits only depend on the input commits
+    and the seed.
+    """
+
+    def __init__(self, data_dir=data_path, dataset_dir=build_path, seed=0, chunk_size=50000, force=False):
+        """
+        :param force: allow replacing the published splits in dataset/
+        """
+        self.data_dir = data_dir
+        self.dataset_dir = dataset_dir
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.force = force
+
+    def read_csv(self, name, columns):
+        path = os.path.join(self.data_dir, name)
+        return pd.read_csv(path, dtype={'commit_id': str}) if os.path.isfile(path) else \
+            pd.DataFrame(columns=columns)
+
+    @staticmethod
+    def strata(dates):
+        return ((dates - MIN_DATE) // STRATA_SIZE).astype(np.int64)
+
+    def labeled_commits(self, last_year=LAST_YEAR):
+        """
+        buggy, fix and clean commits with subtrees, their date, stratum and year
+        """
+        buggy_fix = pd.merge(self.read_csv('keys_apachejava_ast.csv', ['commit_id']),
+                             pd.read_csv(os.path.join(self.data_dir, 'apachejava.csv'), dtype={'commit_id': str}),
+                             on='commit_id')
+        clean = pd.merge(pd.read_csv(os.path.join(self.data_dir, 'clean_filtered.csv'), dtype={'commit_id': str})
+                         .rename(columns={'commit_date': 'date'}),
+                         self.read_csv('keys_clean_ast.csv', ['commit_id']), on='commit_id')
+        clean = clean[~clean['commit_id'].isin(buggy_fix['commit_id'])]
+        clean = clean.assign(buggy=False, fix=False)
+        columns = ['commit_id', 'project', 'buggy', 'fix', 'date']
+        commits = pd.concat([buggy_fix[columns], clean[columns]], ignore_index=True)
+        commits['strata'] = self.strata(commits['date'])
+        commits['year'] = commits['strata'] + FIRST_YEAR
+        if last_year is not None:
+            commits = commits[commits['year'] <= last_year]
+        return commits
+
+    @staticmethod
+    def clean_quota(b_train, f_train):
+        """
+        clean commits to draw per stratum: the strata distribution of the buggy commits applied to
+        the difference between the buggy and fix commits, as in the notebook
+        """
+        share = b_train['strata'].value_counts(normalize=True)
+        return (share * (len(b_train) - len(f_train))).astype(np.int64)
+
+    @staticmethod
+    def sample_clean(c_train, quota, rng):
+        """
+        draws min(quota, size) clean commits of every stratum in one pass: the commits are sorted by
+        stratum and a random key, and the first `quota` of each stratum are kept
+        """
+        keys = rng.random(len(c_train))
+        ordered = c_train.iloc[np.lexsort((keys, c_train['strata'].values))]
+        rank = ordered.groupby('strata').cumcount()
+        return ordered[rank.values < ordered['strata'].map(quota).fillna(0).values]
+
+    def splits(self, commits):
+        """
+        :return: dict split -> commits of the split, in the order they are written
+        """
+        commits = commits.sort_values('commit_id', kind='stable').reset_index(drop=True)
+        test_rng, small_rng, clean_rng = [np.random.default_rng(s) for s in np.random.SeedSequence(self.seed).spawn(3)]
+        buggy = commits[commits['buggy']]
+        fix = commits[commits['fix'] & ~commits['buggy']]
+        clean = commits[~commits['buggy'] & ~commits['fix']]
+
+        test = pd.concat([buggy[buggy['strata'] >= TEST_STRATUM], fix[fix['strata'] >= TEST_STRATUM],
+                          clean[clean['strata'] >= TEST_STRATUM]])
+        test = test.iloc[test_rng.permutation(len(test))]
+        test_small = test.iloc[np.sort(small_rng.choice(len(test), int(round(TEST_SMALL_FRAC * len(test))),
+                                                        replace=False))]
+
+        b_train, f_train, c_train = [df[df['strata'] < TEST_STRATUM] for df in (buggy, fix, clean)]
+        sample = self.sample_clean(c_train, self.clean_quota(b_train, f_train), clean_rng)
+        train = pd.concat([b_train, f_train, sample])
+
+        total = pd.concat([buggy, fix, clean]).sort_values('year', kind='stable')
+        return {'total': total, 'train': train, 'test_large': test, 'test_small': test_small}
+
+    def join_metrics(self, splits, scratch):
+        """
+        streams the Kamei metrics in chunks and joins every chunk with the commits of each split, only the
+        commits are kept in memory. the joined rows go to bucket files of chunk_size consecutive positions
+        of their split, the metrics of a commit appearing twice are the first ones
+        :return: the metric columns
+        """
+        metrics_file = os.path.join(self.data_dir, 'apache_metrics_kamei.csv')
+        keyed = {split: df[COMMIT_COLUMNS].assign(position=np.arange(len(df))).set_index('commit_id')
+                 for split, df in splits.items()}
+        seen = set()
+        for chunk in pd.read_csv(metrics_file, dtype=METRIC_DTYPES, chunksize=self.chunk_size):
+            chunk = chunk.drop_duplicates('commit_id')
+            chunk = chunk[~chunk['commit_id'].isin(seen)]
+            seen.update(chunk['commit_id'])
+            chunk = chunk.set_index('commit_id')
+            for split, commits in keyed.items():
+                joined = commits.join(chunk, how='inner')
+                for bucket, rows in joined.groupby(joined['position'] // self.chunk_size):
+                    rows.to_csv(os.path.join(scratch, '{}_{}.csv'.format(split, bucket)), mode='a', header=False)
+        return [c for c in pd.read_csv(metrics_file, nrows=0).columns if c != 'commit_id']
+
+    def write_split(self, split, length, metric_columns, scratch, path):
+        """
+        writes the joined rows of a split bucket by bucket in the order of the split, the commits without
+        metrics are dropped
+        :return: number of rows written
+        """
+        names = COMMIT_COLUMNS + ['position'] + metric_columns
+        dtypes = dict({'commit_id': str}, **{c: t for c, t in METRIC_DTYPES.items() if c in metric_columns})
+        rows = 0
+        with open(path + '.tmp', 'w', newline='') as file:
+            file.write(','.join(COMMIT_COLUMNS + metric_columns) + '\n')
+            for bucket in range(0, (length + self.chunk_size - 1) // self.chunk_size):
+                bucket_file = os.path.join(scratch, '{}_{}.csv'.format(split, bucket))
+                if not os.path.isfile(bucket_file):
+                    continue
+                chunk = pd.read_csv(bucket_file, names=names, dtype=dtypes).sort_values('position')
+                chunk.drop(columns=['position']).to_csv(file, index=False, header=False)
+                rows += len(chunk)
+        os.replace(path + '.tmp', path)
+        return rows
+
+    def check_overwrite(self, splits):
+        if self.force or os.path.realpath(self.dataset_dir) != os.path.realpath(dataset_path):
+            return
+        published = [s for s in splits if os.path.isfile(os.path.join(dataset_path, 'apachejit_{}.csv'.format(s)))]
+        if published:
+            raise FileExistsError('the published splits {} are in {}, pass --force to replace them'
+                                  .format(published, dataset_path))
+
+    def build(self, splits=SPLITS):
+        self.check_overwrite(splits)
+        commits = self.labeled_commits()
+        logging.info('{} commits: {} buggy, {} fix'.format(len(commits), commits['buggy'].sum(),
+                                                           (commits['fix'] & ~commits['buggy']).sum()))
+        os.makedirs(self.dataset_dir, exist_ok=True)
+        selected = {split: df for split, df in self.splits(commits).items() if split in splits}
+        sizes = dict()
+        with tempfile.TemporaryDirectory(prefix='splits-', dir=self.dataset_dir) as scratch:
+            metric_columns = self.join_metrics(selected, scratch)
+            for split, df in selected.items():
+                sizes[split] = self.write_split(split, len(df), metric_columns, scratch,
+                                                os.path.join(self.dataset_dir, 'apachejit_{}.csv'.format(split)))
+                logging.info('{}: {} of {} commits written'.format(split, sizes[split], len(df)))
+        return sizes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default=data_path, type=str, help="directory of the filtered commits and metrics")
+    parser.add_argument("--dataset", default=build_path, type=str, help="output directory of the splits")
+    parser.add_argument("--force", action='store_true', help="allow replacing the published splits in dataset/")
+    parser.add_argument("--seed", default=0, type=int, help="seed of the test shuffle and the clean sample")
+    parser.add_argument("--splits", nargs='*', default=SPLITS, choices=SPLITS, help="splits to write")
+    parser.add_argument("--chunk-size", default=50000, type=int, help="metric rows read and split rows written at once")
+    parser.add_argument("--columnar", action='store_true', help="also export the splits to the columnar format")
+    args = parser.parse_args()
+
+    Path("logs/").mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S',
+                        handlers=[
+                            RotatingFileHandler(filename='logs/dataset.log', maxBytes=5 * 1024 * 1024,
+                                                backupCount=5)])
+    builder = DatasetBuilder(args.data, args.dataset, args.seed, args.chunk_size, args.force)
+    for split, rows in builder.build(args.splits).items():
+        print('{}: {} commits'.format(split, rows))
+    if args.columnar:
+        export_dataset(args.dataset, args.splits)
+    print('finished.')
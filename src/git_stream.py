@@ -0,0 +1,79 @@
+import codecs
+import subprocess
+import threading
+import time
+
+
+def unquote_path(path):
+    """
+    git still quotes paths with control characters, `"` or `\\` under core.quotepath=off, in C style
+    """
+    if len(path) > 1 and path.startswith('"') and path.endswith('"'):
+        return codecs.escape_decode(path[1:-1].encode('utf-8'))[0].decode('utf-8', errors='replace')
+    return path
+
+
+def numstat_path(path):
+    """
+    (old path, new path) of a `--numstat` entry, renames are reported as `old => new` or `dir/{old => new}/file`
+    """
+    if ' => ' not in path:
+        path = unquote_path(path)
+        return path, path
+    if '{' in path:
+        prefix, rest = path.split('{', 1)
+        renamed, suffix = rest.split('}', 1)
+        old, new = renamed.split(' => ')
+        return (prefix + old + suffix).replace('//', '/'), (prefix + new + suffix).replace('//', '/')
+    old, new = path.split(' => ')
+    return unquote_path(old), unquote_path(new)
+
+
+def stream_numstat(repo, args, stdin=None):
+    """
+    runs `git log <args> --numstat` with a `--format` whose lines start with %x00 and yields
+    (header fields, [(added, deleted, old_path, new_path), ...]) per commit. binary files count 0 lines.
+    :param stdin: revisions for `--stdin`, written from a thread so the output can be streamed
+    """
+    # non-ASCII paths are quoted and escaped by default, which would hide their extension
+    log = subprocess.Popen(['git', '-C', repo, '-c', 'core.quotepath=off', 'log', *args, '--numstat'],
+                           stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='replace')
+    writer = None
+    if stdin is not None:
+        writer = threading.Thread(target=lambda: (log.stdin.write(''.join(r + '\n' for r in stdin)),
+                                                  log.stdin.close()))
+        writer.start()
+    header, files = None, []
+    for line in log.stdout:
+        line = line.rstrip('\n')
+        if line.startswith('\0'):
+            if header is not None:
+                yield header, files
+            header, files = line[1:].split('\0'), []
+        elif line and header is not None:
+            added, deleted, path = line.split('\t', 2)
+            files.append((int(added) if added != '-' else 0, int(deleted) if deleted != '-' else 0,
+                          *numstat_path(path)))
+    if header is not None:
+        yield header, files
+    if writer is not None:
+        writer.join()
+    if log.wait() != 0:
+        raise subprocess.CalledProcessError(log.returncode, log.args)
+
+
+def open_repository(factory, retries=20):
+    """
+    creates a PyDriller Git (or GitRepository) and opens its repo. opening writes blame.markUnblamableLines
+    to .git/config, so processes opening the same repo at once can fail on its lock and are retried.
+    """
+    for attempt in range(retries):
+        try:
+            git = factory()
+            git.repo
+            return git
+        except OSError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
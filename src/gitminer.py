@@ -1,6 +1,11 @@
 import argparse
+import hashlib
+import math
 import os
 import pickle
+import shutil
+import subprocess
+from multiprocessing import Pool
 
 import pandas as pd
 from pydriller import Repository, Git
@@ -9,13 +14,146 @@ from logging.handlers import RotatingFileHandler
 from pathlib import Path
 import datetime
 
+from blame_cache import BlameCache, CachedGit
+from commit_index import CommitIndex
+from git_stream import open_repository
+import instrumentation
+from instrumentation import timer
+from work_queue import WorkQueue
+
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 data_path = os.path.join(BASE_DIR, 'data')
 
 
+def szz_links(git, commit, project, index):
+    """
+    rows of (fix_hash, fix_date, bug_hash, bug_date, project) for one fixing commit
+    """
+    rows = []
+    with timer('blame'):
+        szz = git.get_commits_last_modified_lines(commit)
+    bug_inducing = sorted(set(c for sublist in [*szz.values()] for c in sublist))
+    bug_dates = index.lookup(bug_inducing)
+    for b in bug_inducing:
+        rows.append((commit.hash, int(commit.committer_date.timestamp()), b, bug_dates[b][0], project))
+    return rows
+
+
+worker_indexes = {}  # commit indexes loaded once per worker process
+
+
+def open_git(repo, cache=None):
+    return open_repository(lambda: Git(repo) if cache is None else CachedGit(repo, cache))
+
+
+def szz_commit(gits, repo, fix_hash, project, cache):
+    """
+    szz_links of one fixing commit, with the Git handles of the worker and its commit indexes
+    """
+    if repo not in gits:
+        gits[repo] = open_git(repo, cache)
+    if repo not in worker_indexes:
+        worker_indexes[repo] = CommitIndex(repo, update=False)  # already brought up to date by the parent
+    git = gits[repo]
+    with timer('get_commit'):
+        commit = git.get_commit(fix_hash)
+    instrumentation.count('fix_commits')
+    return szz_links(git, commit, project, worker_indexes[repo])
+
+
+def szz_worker(task):
+    """
+    runs SZZ on a chunk of (repo, fix_hash) pairs in a worker process with its own Git handles
+    """
+    project, chunk, cache_path = task
+    cache = BlameCache(cache_path) if cache_path is not None else None
+    gits = {}
+    rows = []
+    for repo, fix_hash in chunk:
+        rows += szz_commit(gits, repo, fix_hash, project, cache)
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    if cache is not None:
+        cache.close()
+    return len(chunk), rows, hits, misses
+
+
+def szz_queue_worker(task):
+    """
+    runs SZZ on the fix commits of a WorkQueue until it is drained, the rows of each commit are its result
+    """
+    queue, repo_dir, project, batch, cache_path = task
+    cache = BlameCache(cache_path) if cache_path is not None else None
+    gits = {}
+    completed = queue.run(lambda fix_hash, repo: szz_commit(gits, os.path.join(repo_dir, repo), fix_hash,
+                                                            project, cache), batch)
+    if cache is not None:
+        cache.close()
+    queue.close()
+    return completed
+
+
+def clean_worker(task):
+    """
+    streams (hash, committer date) of one repo with `git log` into a checkpoint csv, skipping bug-fix commits.
+    an interrupted run resumes after the last complete row of the checkpoint, or starts over when that row
+    is no longer in the log.
+    """
+    repo, since, to, bug_fix, part_file, checkpoint_rate = task
+    done_file = part_file + '.done'
+    if os.path.isfile(done_file):
+        return part_file
+    last = None
+    if os.path.isfile(part_file):
+        with open(part_file, 'rb+') as file:
+            content = file.read()
+            file.truncate(content.rfind(b'\n') + 1)  # drop a partially written row
+        rows = content[:content.rfind(b'\n') + 1].decode().splitlines()
+        if len(rows) > 1:
+            last = rows[-1].split(',')[0]
+        elif not rows:  # interrupted while writing the header
+            os.remove(part_file)
+    if not os.path.isfile(part_file):
+        with open(part_file, 'w') as file:
+            file.write('commit_id,project,commit_date\n')
+    project = 'apache/{}'.format(os.path.basename(repo))
+    # same revision range and date window as Repository(repo, since=..., to=...).traverse_commits()
+    log = subprocess.Popen(['git', '-C', repo, 'log', '--reverse', '--format=%H %ct',
+                            '--since={}'.format(since), '--until={}'.format(to), 'HEAD'],
+                           stdout=subprocess.PIPE, universal_newlines=True)
+    count = 0
+    with open(part_file, 'a') as file:
+        for line in log.stdout:
+            h, date = line.split()
+            if last is not None:
+                if h == last:
+                    last = None
+                continue
+            if h not in bug_fix:
+                file.write('{},{},{}\n'.format(h, project, date))
+                count += 1
+                if count % checkpoint_rate == 0:
+                    with timer('checkpoint'):
+                        file.flush()
+                    logging.info('{}: {} clean commits checkpointed'.format(project, count))
+    if log.wait() != 0:
+        raise subprocess.CalledProcessError(log.returncode, log.args)
+    if last is not None:  # the checkpointed commit is gone from the history, the part cannot be resumed
+        logging.warning('{}: resume point {} not found, collecting again'.format(project, last))
+        os.remove(part_file)
+        return clean_worker(task)
+    open(done_file, 'w').close()
+    return part_file
+
+
 class GitMiner:
-    def __init__(self):
+    # start date from notebook (the earliest buggy commit)
+    CLEAN_SINCE = datetime.datetime(2003, 9, 11, 14, 11, 56)
+    # end date from notebook (the latest buggy commit because it's earlier than bug-fix median diff)
+    CLEAN_TO = datetime.datetime(2019, 12, 26, 18, 29, 9)
+
+    def __init__(self, blame_cache=None):
         self.repo_dir = os.path.join(BASE_DIR, 'repos')
+        self.blame_cache = blame_cache  # path of a persistent BlameCache shared by all workers
         self.proj_repo = {'AMQ': ['apache/activemq'], 'CAMEL': ['apache/camel'], 'CASSANDRA': ['apache/cassandra'],
                           'FLINK': ['apache/flink'], 'GROOVY': ['apache/groovy'], 'HBASE': ['apache/hbase'],
                           'HDFS': ['apache/hadoop-hdfs', 'apache/hadoop'], 'HIVE': ['apache/hive'],
@@ -30,39 +168,127 @@ class GitMiner:
                                 RotatingFileHandler(filename='logs/pydriller.log', maxBytes=5 * 1024 * 1024,
                                                     backupCount=5)])
 
-    def run_collector(self, df, project):
+    @staticmethod
+    def ordered_fix_commits(repos, fix_commits):
+        """
+        (repo, fix_hash) pairs in the same order Repository(repos, only_commits=...) visits them
+        """
+        fix_commits = set(fix_commits)
+        ordered = []
+        for repo in repos:
+            out = subprocess.run(['git', '-C', repo, 'rev-list', '--reverse', 'HEAD'],
+                                 stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            ordered += [(repo, h) for h in out.split() if h in fix_commits]
+        return ordered
+
+    @staticmethod
+    def dump_links(data, links_file):
+        with timer('checkpoint'):
+            pd.DataFrame(data).to_csv(links_file, index=False)
+
+    def run_collector(self, df, project, workers=1, links_file=None, dump_rate=500):
         data = {'fix_hash': [], 'fix_date': [], 'bug_hash': [], 'bug_date': [], 'project': []}
         project_df = df[df['project'] == project]
         fix_commits = project_df['commit_id'].tolist()
         repos = [os.path.join(self.repo_dir, r.split('/')[-1]) for r in self.proj_repo[project]]
+        indexes = {r: CommitIndex(r) for r in repos if os.path.isdir(r)}
+        if workers > 1:
+            return self.run_collector_parallel(data, fix_commits, repos, project, workers, links_file, dump_rate)
+        cache = BlameCache(self.blame_cache) if self.blame_cache is not None else None
         count = 0
         for commit in Repository(repos,
                                  only_commits=fix_commits).traverse_commits():
-            git = Git(commit.project_path)
-            szz = git.get_commits_last_modified_lines(commit)
-            bug_inducing = set(c for sublist in [*szz.values()] for c in sublist)
-            for b in bug_inducing:
-                data['fix_hash'].append(commit.hash)
-                data['fix_date'].append(int(commit.committer_date.timestamp()))
-                data['bug_hash'].append(b)
-                data['bug_date'].append(int(git.get_commit(b).committer_date.timestamp()))
-                data['project'].append(project)
+            git = open_git(commit.project_path, cache)
+            index = indexes[os.path.join(self.repo_dir, commit.project_name)]
+            for row in szz_links(git, commit, project, index):
+                for k, v in zip(data.keys(), row):
+                    data[k].append(v)
             count += 1
+            instrumentation.count('fix_commits')
             logging.info('Completed {:.2f} %'.format((count / len(fix_commits)) * 100))
+            if links_file is not None and count % dump_rate == 0:
+                self.dump_links(data, links_file)
+        if cache is not None:
+            logging.info('blame cache: {}'.format(cache.stats()))
+            cache.close()
+
+        return data
+
+    def run_collector_queue(self, df, project, queue_path, workers=1, links_file=None, batch=10):
+        """
+        SZZ over a WorkQueue, so any number of processes on this host can run the same command and split
+        the fix commits between them, and a restarted run skips the done ones. the process that
+        finds the queue drained writes the links in the serial traversal order.
+        :return: the links, or None while other workers are still busy
+        """
+        fix_commits = df[df['project'] == project]['commit_id'].tolist()
+        repos = [os.path.join(self.repo_dir, r.split('/')[-1]) for r in self.proj_repo[project]]
+        for r in repos:
+            if os.path.isdir(r):
+                CommitIndex(r)
+        queue = WorkQueue(queue_path, 'szz/{}'.format(project))
+        # repos are stored by name and resolved against the repo_dir of the worker
+        added = queue.add((h, os.path.basename(repo)) for repo, h in self.ordered_fix_commits(repos, fix_commits))
+        logging.info('{} new fix commits of {} queued, {}'.format(added, project, queue.counts()))
+        task = (queue, self.repo_dir, project, batch, self.blame_cache)
+        if workers > 1:
+            with Pool(workers) as pool:
+                completed = sum(pool.map(szz_queue_worker, [task] * workers))
+        else:
+            completed = szz_queue_worker(task)
+        logging.info('{} fix commits of {} completed by this host, {}'.format(completed, project, queue.counts()))
+        if not queue.try_finalize():
+            return None
+        data = {'fix_hash': [], 'fix_date': [], 'bug_hash': [], 'bug_date': [], 'project': []}
+        for _, _, rows in queue.results():
+            for row in rows:
+                for k, v in zip(data.keys(), row):
+                    data[k].append(v)
+        for fix_hash, error in queue.failed():
+            logging.error('SZZ failed on {}: {}'.format(fix_hash, error))
+        if links_file is not None:
+            self.dump_links(data, links_file)
+        queue.finish_finalize()
+        queue.close()
+        return data
+
+    def run_collector_parallel(self, data, fix_commits, repos, project, workers, links_file, dump_rate):
+        """
+        splits the fix commits into contiguous chunks of the serial traversal order and runs SZZ on them
+        in a process pool. chunks are merged in order, so the result is identical to the serial run.
+        """
+        ordered = self.ordered_fix_commits(repos, fix_commits)
+        chunk_size = max(1, min(50, math.ceil(len(ordered) / (workers * 8))))
+        chunks = [(project, ordered[i:i + chunk_size], self.blame_cache) for i in range(0, len(ordered), chunk_size)]
+        logging.info('{} fix commits of {} split into {} chunks for {} workers'
+                     .format(len(ordered), project, len(chunks), workers))
+        count, dumped, hits, misses = 0, 0, 0, 0
+        with Pool(workers) as pool:
+            for n, rows, chunk_hits, chunk_misses in pool.imap(szz_worker, chunks):
+                hits += chunk_hits
+                misses += chunk_misses
+                for row in rows:
+                    for k, v in zip(data.keys(), row):
+                        data[k].append(v)
+                count += n
+                logging.info('Completed {:.2f} %'.format((count / len(fix_commits)) * 100))
+                if links_file is not None and count - dumped >= dump_rate:
+                    self.dump_links(data, links_file)
+                    dumped = count
+        if self.blame_cache is not None:
+            logging.info('blame cache: {} hits, {} misses'.format(hits, misses))
 
         return data
 
     def collect_clean(self):
         repos = [os.path.join(self.repo_dir, r.split('/')[-1]) for r in
                  [c for sublist in [*self.proj_repo.values()] for c in sublist]]
-        all_commits = pd.read_csv(os.path.join(data_path, 'bug_fix_all.csv'))['commit_id'].tolist()
+        all_commits = set(pd.read_csv(os.path.join(data_path, 'bug_fix_all.csv'))['commit_id'])
         clean_commits, projects, dates = [], [], []
         count = 0
         for commit in Repository(repos,
-                                 # start and date from notebook (the earliest buggy commit)
-                                 since=datetime.datetime(2003, 9, 11, 14, 11, 56),
-                                 # end date from notebook (the latest buggy commit because it's earlier than bug-fix median diff)
-                                 to=datetime.datetime(2019, 12, 26, 18, 29, 9)).traverse_commits():
+                                 since=self.CLEAN_SINCE,
+                                 to=self.CLEAN_TO).traverse_commits():
             if commit.hash not in all_commits:
                 clean_commits.append(commit.hash)
                 projects.append('apache/{}'.format(commit.project_name))
@@ -76,17 +302,67 @@ class GitMiner:
         pd.DataFrame({'commit_id': clean_commits, 'project': projects, 'commit_date': dates}) \
             .drop_duplicates().to_csv(os.path.join(data_path, 'clean.csv'), index=False)
 
+    def collect_clean_fast(self, workers=4, checkpoint_rate=1000):
+        """
+        same output as collect_clean, but enumerates the repos in parallel from `git log`
+        into per-repo checkpoint files instead of traversing them with PyDriller.
+        the checkpoints are kept under a key of the date window, the repo HEADs and bug_fix_all.csv, the ones
+        of other inputs are deleted.
+        """
+        repos = [os.path.join(self.repo_dir, r.split('/')[-1]) for r in
+                 [c for sublist in [*self.proj_repo.values()] for c in sublist]]
+        bug_fix = set(pd.read_csv(os.path.join(data_path, 'bug_fix_all.csv'))['commit_id'])
+        heads = [subprocess.run(['git', '-C', r, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout.strip() for r in dict.fromkeys(repos)]
+        key = hashlib.sha1('{}\n{}\n{}\n{}'.format(self.CLEAN_SINCE, self.CLEAN_TO, '\n'.join(heads),
+                                                  '\n'.join(sorted(bug_fix))).encode('utf-8')).hexdigest()[:16]
+        parts_root = os.path.join(data_path, 'clean_parts')
+        parts_dir = os.path.join(parts_root, key)
+        if os.path.isdir(parts_root):
+            for stale in os.listdir(parts_root):
+                path = os.path.join(parts_root, stale)
+                if stale == key:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:  # parts of the unkeyed layout
+                    os.remove(path)
+        Path(parts_dir).mkdir(parents=True, exist_ok=True)
+        tasks = [(r, self.CLEAN_SINCE, self.CLEAN_TO, bug_fix,
+                  os.path.join(parts_dir, '{}.csv'.format(os.path.basename(r))), checkpoint_rate)
+                 for r in dict.fromkeys(repos)]
+        with Pool(workers) as pool:
+            part_files = dict(zip(dict.fromkeys(repos), pool.map(clean_worker, tasks, chunksize=1)))
+        # repos are concatenated in traversal order (apache/hadoop twice, like Repository does)
+        clean = pd.concat([pd.read_csv(part_files[r]) for r in repos])
+        clean.drop_duplicates().to_csv(os.path.join(data_path, 'clean.csv'), index=False)
+        logging.info('{} clean commits collected'.format(len(clean)))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--project", default=None, type=str, help="")
+    parser.add_argument("--workers", default=1, type=int, help="number of SZZ worker processes")
+    parser.add_argument("--blame-cache", default=None, type=str, help="path of the persistent blame cache")
+    parser.add_argument("--fast-clean", action='store_true', help="enumerate clean commits with git log in parallel")
+    parser.add_argument("--queue", default=None, type=str, help="work queue database shared by the SZZ workers of this host, on a local disk")
+    parser.add_argument("--batch", default=10, type=int, help="fix commits claimed at once from the work queue")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    instrumentation.configure_from_args(args)
     project = args.project
     df = pd.read_csv(os.path.join(data_path, 'found.csv'))
-    miner = GitMiner()
-    data = miner.run_collector(df, project)
-    df = pd.DataFrame(data)
-    df.to_csv(os.path.join(data_path, 'commit_links_{}.csv'.format(project)), index=False)
-    print('{} finished.'.format(project))
-    miner.collect_clean()
+    miner = GitMiner(blame_cache=args.blame_cache)
+    links_file = os.path.join(data_path, 'commit_links_{}.csv'.format(project))
+    if args.queue is not None:
+        data = miner.run_collector_queue(df, project, args.queue, workers=args.workers, links_file=links_file,
+                                         batch=args.batch)
+    else:
+        data = miner.run_collector(df, project, workers=args.workers, links_file=links_file)
+        miner.dump_links(data, links_file)
+    print('{} done on this host.'.format(project))
+    if args.fast_clean:
+        miner.collect_clean_fast(workers=max(args.workers, 1))
+    else:
+        miner.collect_clean()
     print('finished.')
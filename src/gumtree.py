@@ -2,38 +2,173 @@ import json
 import logging
 import math
 import os
+import queue
 import re
 import subprocess
+import tempfile
+import threading
 import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 
 import pandas as pd
 from pydriller import GitRepository
 
+from git_stream import open_repository, stream_numstat
+from instrumentation import count, timer
+from java_tokens import is_significant
+from subtree_cache import SubtreeCache
+from subtree_store import SubtreeStore, shard_path
+from work_queue import WorkQueue
+
 BASE_PATH = os.path.dirname(os.path.dirname(__file__))
 data_path = os.path.join(BASE_PATH, 'data')
 
+NODE_LINE = re.compile('^(n_[0-9]+_[0-9]+) \\[label="(.+)", color=(red|blue)\\];$')
+EDGE_LINE = re.compile('^(n_[0-9]+_[0-9]+) -> (n_[0-9]+_[0-9]+);$')
+DOT_LINE = re.compile('^n_[0-9]+_[0-9]+ (?:\\[label=".+", color=(?:red|blue)\\]|-> n_[0-9]+_[0-9]+);$')
+LABEL_SUFFIX = re.compile('\\[[0-9]+')
+
+subtree_worker_state = dict()  # per process state of the store_subtrees workers
+
+
+class GumTreeWorker:
+    """
+    A long-running JVM (src/java/GumTreeWorker.java) that answers many dotdiff requests,
+    so the JVM startup is paid once instead of once per modified file.
+    """
+    jar_path = os.path.join(BASE_PATH, 'gumtree-3.0.0/lib/gumtree.jar')
+    java_src = os.path.join(BASE_PATH, 'src/java/GumTreeWorker.java')
+    class_dir = os.path.join(BASE_PATH, 'gumtree-3.0.0/worker')
+    compile_lock = threading.Lock()
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.process = None
+        self.lines = None
+
+    @classmethod
+    def compile(cls):
+        with cls.compile_lock:
+            class_file = os.path.join(cls.class_dir, 'GumTreeWorker.class')
+            if os.path.isfile(class_file) and os.path.getmtime(class_file) >= os.path.getmtime(cls.java_src):
+                return
+            os.makedirs(cls.class_dir, exist_ok=True)
+            subprocess.run(['javac', '-cp', cls.jar_path, '-d', cls.class_dir, cls.java_src], check=True)
+
+    def start(self):
+        self.compile()
+        self.process = subprocess.Popen(['java', '-cp', os.pathsep.join([self.jar_path, self.class_dir]),
+                                         'GumTreeWorker'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        universal_newlines=True, encoding='utf-8')
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read_output, args=(self.process.stdout, self.lines), daemon=True).start()
+
+    @staticmethod
+    def read_output(stream, lines):
+        for line in stream:
+            lines.put(line)
+        lines.put(None)  # the JVM exited
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def diff(self, b_file, a_file, retry=True):
+        """
+        :return: dot output of the pair, or None if GumTree failed (same as GumTreeDiff.get_diff)
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        try:
+            self.process.stdin.write('{}\t{}\n'.format(b_file, a_file))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.stop()
+            return self.diff(b_file, a_file, retry=False) if retry else None
+        output = []
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                logging.warning('GumTree worker timed out on %s, restarting', a_file)
+                self.stop()
+                return None
+            if line is None:  # crashed, restart and try the pair once more
+                logging.warning('GumTree worker crashed on %s, restarting', a_file)
+                self.stop()
+                return self.diff(b_file, a_file, retry=False) if retry else None
+            if line.startswith('#END '):
+                return ''.join(output) if line.strip() == '#END OK' else None
+            output.append(line)
+
+
+class GumTreeWorkerPool:
+    """
+    A fixed number of GumTreeWorker JVMs shared by the threads of one process.
+    """
+
+    def __init__(self, size=1, timeout=60):
+        self.workers = queue.Queue()
+        for _ in range(size):
+            self.workers.put(GumTreeWorker(timeout))
+
+    def diff(self, b_file, a_file):
+        worker = self.workers.get()
+        try:
+            return worker.diff(b_file, a_file)
+        finally:
+            self.workers.put(worker)
+
+    def close(self):
+        while not self.workers.empty():
+            self.workers.get().stop()
+
 
 class GumTreeDiff:
-    def __init__(self):
+    def __init__(self, backend='process', workers=1, timeout=60):
+        """
+        :param backend: `process` spawns `gumtree dotdiff` per file pair, `worker` sends the pairs
+        to a pool of long-running GumTree JVMs
+        """
         self.bin_path = os.path.join(BASE_PATH, 'gumtree-3.0.0/bin/gumtree')
         self.src_dir = os.path.join(data_path, 'src')
         if not os.path.exists(self.src_dir):
             os.makedirs(self.src_dir)
+        # diff inputs go to unique scratch directories on a RAM-backed filesystem when there is one
+        self.scratch_dir = '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+        self.pool = GumTreeWorkerPool(workers, timeout) if backend == 'worker' else None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
 
     def get_diff(self, fname, b_content, a_content):
-        fname = fname.split('/')[-1]
-        b_file = os.path.join(self.src_dir, fname.split('.')[0] + '_b.' + fname.split('.')[1])
-        a_file = os.path.join(self.src_dir, fname.split('.')[0] + '_a.' + fname.split('.')[1])
-        with open(b_file, 'w') as file:
-            file.write(b_content)
-        with open(a_file, 'w') as file:
-            file.write(a_content)
-        command = subprocess.Popen([self.bin_path, 'dotdiff', b_file, a_file],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        output, error = command.communicate()
+        # a private directory per call, so concurrent diffs of files with the same name cannot collide
+        with tempfile.TemporaryDirectory(prefix='gumtree-', dir=self.scratch_dir) as scratch:
+            fname = fname.split('/')[-1]
+            b_file = os.path.join(scratch, fname.split('.')[0] + '_b.' + fname.split('.')[1])
+            a_file = os.path.join(scratch, fname.split('.')[0] + '_a.' + fname.split('.')[1])
+            with open(b_file, 'w') as file:
+                file.write(b_content)
+            with open(a_file, 'w') as file:
+                file.write(a_content)
+            return self.run_gumtree(b_file, a_file)
+
+    def run_gumtree(self, b_file, a_file):
+        with timer('gumtree'):
+            if self.pool is not None:
+                return self.pool.diff(b_file, a_file)
+            command = subprocess.Popen([self.bin_path, 'dotdiff', b_file, a_file],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            output, error = command.communicate()
         if error.decode('utf-8'):
             return None
         return output.decode('utf-8')
@@ -47,100 +182,93 @@ class GumTreeDiff:
             'before': [],
             'after': []
         }
-        current = 'before'
-        node_pattern = '^n_[0-9]+_[0-9]+ \\[label=".+", color=(red|blue)\\];$'
-        edge_pattern = '^n_[0-9]+_[0-9]+ -> n_[0-9]+_[0-9]+;$'
-
+        current = dotfiles['before']
         for l in lines:
             if l == 'subgraph cluster_dst {':
-                current = 'after'
-            if not re.match(node_pattern, l) and not re.match(edge_pattern, l):
-                continue
-            dotfiles[current].append(l)
+                current = dotfiles['after']
+            elif DOT_LINE.match(l):
+                current.append(l)
 
         return dotfiles['before'], dotfiles['after']
 
 
 class SubTreeExtractor:
+    VERSION = 1  # bump whenever the extracted (features, edges, colors) change, it invalidates SubtreeCache
+
     def __init__(self, dot):
         self.dot = dot
-        self.red_nodes = list()
+        self.node_ids = dict()  # dot node name (n_x_y) -> integer id
+        self.node_names = list()  # integer id -> dot node name
+        self.red_nodes = set()
         self.node_dict = dict()
         self.from_to = dict()  # mapping from src nodes to list of their dst nodes.
         self.to_from = dict()  # mapping from dst nodes to list of their src nodes.
-        self.subtree_nodes = set()
-        self.subtree_edges = set()
+        self.subtree_nodes = dict()  # used as an insertion ordered set
+        self.subtree_edges = dict()  # used as an insertion ordered set
+
+    def node_id(self, name):
+        node = self.node_ids.get(name)
+        if node is None:
+            node = self.node_ids[name] = len(self.node_names)
+            self.node_names.append(name)
+        return node
 
     def read_ast(self):
-        node_pattern = '^n_[0-9]+_[0-9]+ \\[label=".+", color=(red|blue)\\];$'
-        edge_pattern = '^n_[0-9]+_[0-9]+ -> n_[0-9]+_[0-9]+;$'
         for line in self.dot:
-            if re.match(node_pattern, line):
-                assert len(re.findall('^(.*) \\[label=".+", color=.+\\];$', line)) == 1
-                id = re.findall('^(.*) \\[label=".+", color=.+\\];$', line)[0]
-                assert len(re.findall('^n_[0-9]+_[0-9]+ \\[label="(.+)", color=.+\\];$', line)) == 1
-                unclean_label = re.findall('^n_[0-9]+_[0-9]+ \\[label="(.+)", color=.+\\];$', line)[0]
-                label = re.split('\\[[0-9]+', unclean_label)[0]
-                assert len(re.findall('color=(red|blue)\\];$', line)) == 1
-                color = re.findall('color=(red|blue)\\];$', line)[0]
-
-                self.node_dict[id] = label
+            match = NODE_LINE.match(line)
+            if match:
+                name, unclean_label, color = match.groups()
+                node = self.node_id(name)
+                self.node_dict[node] = LABEL_SUFFIX.split(unclean_label, 1)[0]
                 if color == 'red':
-                    self.red_nodes.append(id)
-
-            elif re.match(edge_pattern, line):
-                assert len(re.findall('^(.*) -> n_[0-9]+_[0-9]+;$', line)) == 1
-                source = re.findall('^(.*) -> n_[0-9]+_[0-9]+;$', line)[0]
-                assert len(re.findall('^n_[0-9]+_[0-9]+ -> (.*);$', line)) == 1
-                dest = re.findall('^n_[0-9]+_[0-9]+ -> (.*);$', line)[0]
-
-                if source not in self.from_to:
-                    self.from_to[source] = [dest]
-                else:
-                    self.from_to[source].append(dest)
-                if dest not in self.to_from:
-                    self.to_from[dest] = [source]
-                else:
-                    self.to_from[dest].append(source)
-
+                    self.red_nodes.add(node)
+                continue
+            match = EDGE_LINE.match(line)
+            if match:
+                source, dest = self.node_id(match.group(1)), self.node_id(match.group(2))
+                self.from_to.setdefault(source, []).append(dest)
+                self.to_from.setdefault(dest, []).append(source)
             else:
                 print(line, end='\t')
 
     def extract_subtree(self):
+        with timer('extract'):
+            return self.extract()
+
+    def extract(self):
         self.read_ast()
+        nodes, edges = self.subtree_nodes, self.subtree_edges
+        expanded = set()  # parents whose children are already in the subtree
         for n in self.red_nodes:
-            self.subtree_nodes.add(n)
-            if n in self.from_to:
-                for d in self.from_to[n]:
-                    self.subtree_nodes.add(d)
-                    self.subtree_edges.add((n, d))
-            if n in self.to_from:
-                for s in self.to_from[n]:
-                    self.subtree_nodes.add(s)
-                    self.subtree_edges.add((s, n))
-                    for d in self.from_to[s]:
-                        self.subtree_nodes.add(d)
-                        self.subtree_edges.add((s, d))
-
-        vs = list(self.subtree_nodes)
-        es = list(self.subtree_edges)
-        colors = ['red' if node_id in self.red_nodes else "blue" for node_id in vs]
-        features = [[self.node_dict[node_id]] if node_id in self.node_dict else ['unknown'] for node_id in vs]
-        edges = [[], []]
-        for src, dst in es:
-            edges[0].append(vs.index(src))
-            edges[1].append(vs.index(dst))
-
-        return features, edges, colors
+            nodes[n] = None
+            for d in self.from_to.get(n, ()):
+                nodes[d] = None
+                edges[(n, d)] = None
+            for s in self.to_from.get(n, ()):
+                nodes[s] = None
+                edges[(s, n)] = None
+                if s in expanded:
+                    continue
+                expanded.add(s)
+                for d in self.from_to[s]:
+                    nodes[d] = None
+                    edges[(s, d)] = None
+
+        index = {node: i for i, node in enumerate(nodes)}
+        colors = ['red' if node in self.red_nodes else "blue" for node in nodes]
+        features = [[self.node_dict[node]] if node in self.node_dict else ['unknown'] for node in nodes]
+        edge_index = [[index[src] for src, _ in edges], [index[dst] for _, dst in edges]]
+
+        return features, edge_index, colors
 
     def generate_dotfile(self):
         content = 'digraph G {\nnode [style=filled];\nsubgraph cluster_dst {\n'
         for node in self.subtree_nodes:
-            content += '{} [label="{}", color={}];\n'.format(node,
+            content += '{} [label="{}", color={}];\n'.format(self.node_names[node],
                                                              self.node_dict[node],
                                                              'blue' if node not in self.red_nodes else 'red')
-        for edge in self.subtree_edges:
-            content += '{} -> {};\n'.format(edge[0], edge[1])
+        for src, dst in self.subtree_edges:
+            content += '{} -> {};\n'.format(self.node_names[src], self.node_names[dst])
         content += '}\n;}\n'
 
         with open(os.path.join(data_path, 'src', 'new.dot'), 'w') as file:
@@ -148,17 +276,29 @@ class SubTreeExtractor:
 
 
 class RunHandler:
-    def __init__(self, commit_file, ast_filename, already_file, types, limit=10000):
+    def __init__(self, commit_file, ast_filename, already_file, types, limit=10000, store='json',
+                 repo_dir=None, load_shards=True):
+        """
+        :param store: `json` keeps a shard in memory and rewrites `<ast_filename>_N.json`,
+        `append` appends each commit to a SubtreeStore shard `<ast_filename>_N.dat`
+        :param repo_dir: directory of the repo clones, repos/ of the project by default
+        :param load_shards: False when only filtering, the shards are not read and nothing is stored
+        """
         self.commit_file = commit_file
+        self.repo_dir = repo_dir if repo_dir is not None else os.path.join(BASE_PATH, 'repos')
+        self.load_shards = load_shards
         self.ast_filename = ast_filename
         self.types = types
         self.already_file = already_file
         self.limit = limit
+        self.store = store
         self.ast_dict = dict()
         self.file_index = 1
         self.save_file = None
+        self.subtree_store = None
         self.already = []
         self.commits = dict()
+        self.repos = dict()  # one GitRepository per repo path instead of one per commit
         self.initialize()
         Path("logs/").mkdir(parents=True, exist_ok=True)
         logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
@@ -176,6 +316,12 @@ class RunHandler:
         return '{} min {:.2f} sec'.format(m, s)
 
     def initialize(self):
+        if not self.load_shards:
+            self.load_commits(())
+            return
+        if self.store == 'append':
+            self.initialize_store()
+            return
         while not self.save_file:
             filepath = os.path.join(data_path, self.ast_filename + '_{}.json'.format(self.file_index))
             if os.path.isfile(filepath):
@@ -188,14 +334,42 @@ class RunHandler:
             else:
                 self.save_file = filepath
         print('current file: {}\nast dict size: {}\n'.format(self.save_file, len(self.ast_dict)))
+        self.load_commits(self.ast_dict.keys())
+
+    def initialize_store(self):
+        # only the shard indexes are read to find where to resume, not the payloads
+        while True:
+            self.subtree_store = SubtreeStore(shard_path(self.ast_filename, self.file_index))
+            if len(self.subtree_store) < self.limit:
+                break
+            self.subtree_store.close()
+            self.file_index += 1
+        self.save_file = self.subtree_store.data_file
+        print('current file: {}\nstore size: {}\n'.format(self.save_file, len(self.subtree_store)))
+        self.load_commits(self.subtree_store.keys())
+
+    def load_commits(self, stored):
         self.already = pd.read_csv(os.path.join(data_path, self.already_file))['commit_id'].tolist()
         df = pd.read_csv(os.path.join(data_path, self.commit_file))
         commits = df['commit_id']
         projects = df['project']
         commits = dict(zip(commits, projects))
-        remaining = list(set(commits.keys()) - set(self.already) - set(self.ast_dict.keys()))
+        remaining = list(set(commits.keys()) - set(self.already) - set(stored))
         self.commits = {k: commits[k] for k in remaining}
 
+    def get_commit(self, c, p, repo_dir):
+        repo = p.split('/')[1]
+        with timer('get_commit'):
+            try:
+                return self.get_repo(os.path.join(repo_dir, repo)).get_commit(c)
+            except ValueError:  # for hadoop repos
+                return self.get_repo(os.path.join(repo_dir, repo.split('-')[0])).get_commit(c)
+
+    def get_repo(self, path):
+        if path not in self.repos:
+            self.repos[path] = open_repository(lambda: GitRepository(path))
+        return self.repos[path]
+
     def has_modification_with_file_type(self, commit):
         for mod in commit.modifications:
             if mod.filename.endswith(tuple(self.types)):
@@ -214,16 +388,79 @@ class RunHandler:
             return True
         return False
 
+    def is_filtered_numstat(self, files, lines, paths):
+        """
+        same rules as is_filtered, on the file count, changed lines and paths of `git log --numstat`
+        """
+        if files > 100:
+            logging.info('Too many files.')
+            return True
+        if lines > 10000:
+            logging.info('Too many lines.')
+            return True
+        if not any(os.path.basename(path).endswith(tuple(self.types)) for path in paths):
+            logging.info('No file in given language')
+            return True
+        return False
+
+    @staticmethod
+    def read_numstats(repo, hashes):
+        """
+        (committer date, parents, files, lines, paths) of the given commits from one streamed `git log --numstat`
+        """
+        check = subprocess.run(['git', '-C', repo, 'cat-file', '--batch-check'], input='\n'.join(hashes) + '\n',
+                               stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        existing = [line.split()[0] for line in check.splitlines() if line.split()[1:2] == ['commit']]
+        stats = dict()
+        if not existing:
+            return stats
+        for (h, date, parents), files in stream_numstat(repo, ['--no-walk=unsorted', '--stdin', '-M',
+                                                               '--format=%x00%H%x00%ct%x00%P'], stdin=existing):
+            stats[h] = [int(date), parents.split(), len(files), sum(a + d for a, d, _, _ in files),
+                        [new for _, _, _, new in files]]
+        return stats
+
+    def filter_commits_bulk(self, repo_dir=None, out_file='clean_filtered.csv'):
+        """
+        filter_commits without building PyDriller commits: file counts, changed lines and file names
+        come from one `git log --numstat` pass per repo. writes the same clean_filtered.csv.
+        """
+        repo_dir = repo_dir if repo_dir is not None else self.repo_dir
+        by_repo = dict()
+        for c, p in self.commits.items():
+            by_repo.setdefault(p.split('/')[1], []).append(c)
+        stats = dict()
+        for repo, hashes in by_repo.items():
+            stats.update(self.read_numstats(os.path.join(repo_dir, repo), hashes))
+            missing = [c for c in hashes if c not in stats]
+            if missing and repo.split('-')[0] != repo:  # for hadoop repos
+                stats.update(self.read_numstats(os.path.join(repo_dir, repo.split('-')[0]), missing))
+        filtered, projects, dates = [], [], []
+        for c, p in self.commits.items():
+            if c not in stats:
+                logging.warning('Commit #%s not found in %s', c, p)
+                continue
+            date, parents, files, lines, paths = stats[c]
+            logging.info('Commit #%s in %s', c, date)
+            # pydriller reports no modifications for merge commits, so they never have a file in the language
+            if len(parents) > 1:
+                logging.info('No file in given language')
+                continue
+            if self.is_filtered_numstat(files, lines, paths):
+                continue
+            filtered.append(c)
+            projects.append(p)
+            dates.append(date)
+        pd.DataFrame({'commit_id': filtered, 'project': projects, 'date': dates}) \
+            .to_csv(os.path.join(data_path, out_file), index=False)
+
     def filter_commits(self):
         """
         filter commits based on PyDriller
         """
         filtered, projects, dates = [], [], []
         for c, p in self.commits.items():
-            try:
-                commit = GitRepository('../repos/' + p.split('/')[1]).get_commit(c)
-            except ValueError:  # for hadoop repos
-                commit = GitRepository('../repos/' + p.split('/')[1].split('-')[0]).get_commit(c)
+            commit = self.get_commit(c, p, self.repo_dir)
             logging.info('Commit #%s in %s from %s', commit.hash, commit.committer_date, commit.author.name)
             if self.is_filtered(commit):
                 continue
@@ -237,68 +474,275 @@ class RunHandler:
         pd.DataFrame({'commit_id': filtered, 'project': projects, 'date': dates}) \
             .to_csv(os.path.join(data_path, 'clean_filtered.csv'), index=False)
 
-    def store_subtrees(self):
-        gumtree = GumTreeDiff()
-        dataset_start = time.time()
-        for c, p in self.commits.items():
-            try:
-                commit = GitRepository('repos/' + p.split('/')[1]).get_commit(c)
-            except ValueError:  # for hadoop repos
-                commit = GitRepository('repos/' + p.split('/')[1].split('-')[0]).get_commit(c)
-            logging.info('Commit #%s in %s from %s', commit.hash, commit.committer_date, commit.author.name)
-            commit_start = time.time()
-            for m in commit.modifications:
-                if not m.filename.endswith(tuple(self.types)):
-                    continue
-                filepath = m.new_path if m.new_path is not None else m.old_path
+    @staticmethod
+    def diff_subtrees(gumtree, filepath, before, after, cache=None):
+        """
+        :return: (b_subtree, a_subtree) of a modification, or None if GumTree cannot parse the sources
+        """
+        if cache is not None:
+            cached = cache.get_subtrees(filepath, before, after)
+            if cached is not None:
+                return None if cached == SubtreeCache.SYNTAX_ERROR else cached
+        try:
+            with timer('diff'):
+                b_dot, a_dot = gumtree.get_dotfiles((filepath, before, after))
+            subtrees = SubTreeExtractor(b_dot).extract_subtree(), SubTreeExtractor(a_dot).extract_subtree()
+        except SyntaxError:
+            subtrees = None
+        if cache is not None:
+            cache.put_subtrees(filepath, before, after, SubtreeCache.SYNTAX_ERROR if subtrees is None else subtrees)
+        return subtrees
+
+    def commit_subtrees(self, commit, gumtree, cache=None, prefilter='off', prefilter_stats=None):
+        """
+        :return: list of (filepath, b_subtree, a_subtree) for the modifications of a commit
+        """
+        prefilter_stats = prefilter_stats if prefilter_stats is not None else Counter()
+        subtrees_list = []
+        with timer('git_diff'):
+            modifications = commit.modifications
+        count('commits')
+        for m in modifications:
+            if not m.filename.endswith(tuple(self.types)):
+                continue
+            filepath = m.new_path if m.new_path is not None else m.old_path
+            with timer('git_diff'):
                 before = m.source_code_before if m.source_code_before is not None else ''
                 after = m.source_code if m.source_code is not None else ''
-                f = (filepath, before, after)
-                try:
-                    b_dot, a_dot = gumtree.get_dotfiles(f)
-                except SyntaxError:
-                    print('\t\t\t\tsource code has syntax error. PASS!')
-                    continue
-                subtree = SubTreeExtractor(b_dot)
-                b_subtree = subtree.extract_subtree()
-                subtree = SubTreeExtractor(a_dot)
-                a_subtree = subtree.extract_subtree()
-
-                # to exclude ast with no red nodes (which have empty subtrees)
-                # this includes F1 in McIntosh & Kamei (comment and whitespace filtering)
-                if len(b_subtree[0]) == 0 and len(a_subtree[0]) == 0:
-                    continue
-                elif len(b_subtree[0]) == 0:
-                    b_subtree[0].append('None')
-                elif len(a_subtree[0]) == 0:
-                    a_subtree[0].append('None')
-
-                if commit.hash not in self.ast_dict:
-                    self.ast_dict[commit.hash] = [(filepath, b_subtree, a_subtree)]
+            significant = is_significant(before, after) if prefilter != 'off' else None
+            if prefilter == 'on' and not significant:
+                prefilter_stats['dropped'] += 1
+                continue
+            subtrees = self.diff_subtrees(gumtree, filepath, before, after, cache)
+            if subtrees is None:
+                print('\t\t\t\tsource code has syntax error. PASS!')
+                continue
+            b_subtree, a_subtree = subtrees
+            if prefilter == 'verify':
+                has_red_nodes = len(b_subtree[0]) > 0 or len(a_subtree[0]) > 0
+                if significant == has_red_nodes:
+                    prefilter_stats['agree'] += 1
+                elif has_red_nodes:  # the pre-filter would have dropped a significant change
+                    prefilter_stats['dropped_with_red_nodes'] += 1
                 else:
-                    self.ast_dict[commit.hash].append((f[0], b_subtree, a_subtree))
+                    prefilter_stats['kept_without_red_nodes'] += 1
 
-            if commit.hash in self.ast_dict:  # to check if new commit is added
-                print('commit {} subtrees collected in {}.'.format(commit.hash[:7], self.time_since(commit_start)))
-                if len(self.ast_dict) % 100 == 0:
-                    with open(self.save_file, 'w') as fp:
-                        json.dump(self.ast_dict, fp)
-                    print('\n\n***** ast_dict backup saved at size {}. *****\n\n'.format(len(self.ast_dict)))
-                    if len(self.ast_dict) == self.limit:
-                        self.file_index += 1
-                        self.save_file = os.path.join(data_path, self.ast_filename + '_{}.json'.format(self.file_index))
-                        self.already += list(self.ast_dict.keys())
-                        pd.DataFrame({'commit_id': self.already})\
-                            .to_csv(os.path.join(data_path, self.already_file), index=False)
-                        self.ast_dict = dict()
-                        print('\n\n***** switching file *****\n\n')
+            # to exclude ast with no red nodes (which have empty subtrees)
+            # this includes F1 in McIntosh & Kamei (comment and whitespace filtering)
+            if len(b_subtree[0]) == 0 and len(a_subtree[0]) == 0:
+                continue
+            elif len(b_subtree[0]) == 0:
+                b_subtree[0].append('None')
+            elif len(a_subtree[0]) == 0:
+                a_subtree[0].append('None')
 
-        print('\nall {} commit trees extracted in {}'.format(len(self.commits), self.time_since(dataset_start)))
-        with open(self.save_file, 'w') as fp:
+            subtrees_list.append((filepath, b_subtree, a_subtree))
+        return subtrees_list
+
+    def save_already(self, keys):
+        self.already += list(keys)
+        with timer('checkpoint'):
+            pd.DataFrame({'commit_id': self.already}) \
+                .to_csv(os.path.join(data_path, self.already_file), index=False)
+
+    def record_subtrees(self, commit_hash, subtrees_list):
+        """
+        stores the subtrees of one commit in the current shard and switches shards at limit
+        """
+        if self.store == 'append':
+            self.subtree_store.append(commit_hash, subtrees_list)
+            if len(self.subtree_store) == self.limit:
+                self.save_already(self.subtree_store.keys())
+                self.subtree_store.close()
+                self.file_index += 1
+                self.subtree_store = SubtreeStore(shard_path(self.ast_filename, self.file_index))
+                self.save_file = self.subtree_store.data_file
+                print('\n\n***** switching file *****\n\n')
+            return
+        self.ast_dict[commit_hash] = subtrees_list
+        if len(self.ast_dict) % 100 == 0:
+            with timer('checkpoint'), open(self.save_file, 'w') as fp:
+                json.dump(self.ast_dict, fp)
+            print('\n\n***** ast_dict backup saved at size {}. *****\n\n'.format(len(self.ast_dict)))
+            if len(self.ast_dict) == self.limit:
+                self.file_index += 1
+                self.save_file = os.path.join(data_path, self.ast_filename + '_{}.json'.format(self.file_index))
+                self.save_already(self.ast_dict.keys())
+                self.ast_dict = dict()
+                print('\n\n***** switching file *****\n\n')
+
+    def finish_subtrees(self):
+        if self.store == 'append':
+            self.save_already(self.subtree_store.keys())
+            self.subtree_store.close()
+            return
+        with timer('checkpoint'), open(self.save_file, 'w') as fp:
             json.dump(self.ast_dict, fp)
-        self.already += list(self.ast_dict.keys())
-        pd.DataFrame({'commit_id': self.already}) \
-            .to_csv(os.path.join(data_path, self.already_file), index=False)
+        self.save_already(self.ast_dict.keys())
+
+    def __getstate__(self):
+        # worker processes only need the configuration, the shards and bookkeeping stay with the writer
+        state = self.__dict__.copy()
+        state.update(ast_dict=dict(), already=[], commits=dict(), repos=dict(), subtree_store=None)
+        return state
+
+    def print_summary(self, dataset_start, prefilter, prefilter_stats, cache_stats):
+        print('\nall {} commit trees extracted in {}'.format(len(self.commits), self.time_since(dataset_start)))
+        if prefilter != 'off':
+            print('significance pre-filter: {}'.format(dict(prefilter_stats)))
+        if cache_stats is not None:
+            lookups = cache_stats['hits'] + cache_stats['misses']
+            print('subtree cache: {} hits, {} misses ({:.2%} hit rate), {} entries, {:.1f} MB'
+                  .format(cache_stats['hits'], cache_stats['misses'], cache_stats['hits'] / lookups if lookups else 0,
+                          cache_stats['entries'], cache_stats['bytes'] / 1e6))
+
+    def store_subtrees(self, backend='process', workers=1, subtree_cache=None, prefilter='off',
+                       processes=1, max_inflight=None):
+        """
+        :param prefilter: `on` drops comment/whitespace-only modifications with a token comparison before
+        running GumTree, `verify` runs both and reports how often they disagree, `off` only uses GumTree
+        :param processes: number of worker processes, see store_subtrees_parallel
+        """
+        if processes > 1:
+            return self.store_subtrees_parallel(processes, max_inflight or 4 * processes,
+                                                backend, workers, subtree_cache, prefilter)
+        gumtree = GumTreeDiff(backend=backend, workers=workers)
+        cache = SubtreeCache(subtree_cache, SubTreeExtractor.VERSION) if subtree_cache is not None else None
+        prefilter_stats = Counter()
+        dataset_start = time.time()
+        for c, p in self.commits.items():
+            commit = self.get_commit(c, p, self.repo_dir)
+            logging.info('Commit #%s in %s from %s', commit.hash, commit.committer_date, commit.author.name)
+            commit_start = time.time()
+            subtrees_list = self.commit_subtrees(commit, gumtree, cache, prefilter, prefilter_stats)
+            if subtrees_list:  # to check if new commit is added
+                print('commit {} subtrees collected in {}.'.format(commit.hash[:7], self.time_since(commit_start)))
+                self.record_subtrees(commit.hash, subtrees_list)
+
+        gumtree.close()
+        self.print_summary(dataset_start, prefilter, prefilter_stats, cache.stats() if cache is not None else None)
+        if cache is not None:
+            cache.close()
+        self.finish_subtrees()
+
+    def store_subtrees_parallel(self, processes, max_inflight, backend='process', workers=1,
+                                subtree_cache=None, prefilter='off'):
+        """
+        worker processes load, diff and extract the commits, this process is the single writer of the shards
+        and the already_file. results are recorded in the order of self.commits, so the output is the same as
+        store_subtrees, and at most max_inflight commits are queued or waiting to be written.
+        """
+        prefilter_stats = Counter()
+        throughput = dict()  # worker pid -> [commits, busy seconds]
+        cache_stats = dict()  # worker pid -> (hits, misses)
+        dataset_start = time.time()
+        tasks = iter(self.commits.items())
+        with ProcessPoolExecutor(processes, initializer=init_subtree_worker,
+                                 initargs=(self, backend, workers, subtree_cache, prefilter)) as pool:
+            pending = deque(pool.submit(subtree_worker, task) for _, task in zip(range(max_inflight), tasks))
+            done = 0
+            while pending:
+                commit_hash, subtrees_list, stats, pid, elapsed, cache_counts = pending.popleft().result()
+                task = next(tasks, None)
+                if task is not None:
+                    pending.append(pool.submit(subtree_worker, task))
+                prefilter_stats.update(stats)
+                worker = throughput.setdefault(pid, [0, 0.0])
+                worker[0] += 1
+                worker[1] += elapsed
+                cache_stats[pid] = cache_counts
+                if subtrees_list:
+                    print('commit {} subtrees collected in {:.2f} sec.'.format(commit_hash[:7], elapsed))
+                    self.record_subtrees(commit_hash, subtrees_list)
+                done += 1
+                if done % 100 == 0:
+                    logging.info('Completed {:.2f} %'.format((done / len(self.commits)) * 100))
+        for pid, (commits, busy) in sorted(throughput.items()):
+            print('worker {}: {} commits, {:.2f} commits/sec'.format(pid, commits, commits / busy if busy else 0))
+        totals = None
+        if subtree_cache is not None:
+            cache = SubtreeCache(subtree_cache, SubTreeExtractor.VERSION)
+            totals = dict(cache.stats(), hits=sum(h for h, _ in cache_stats.values()),
+                          misses=sum(m for _, m in cache_stats.values()))
+            cache.close()
+        self.print_summary(dataset_start, prefilter, prefilter_stats, totals)
+        self.finish_subtrees()
+
+    def store_subtrees_queue(self, queue_path, processes=1, batch=10, backend='process', workers=1,
+                             subtree_cache=None, prefilter='off'):
+        """
+        store_subtrees over a WorkQueue, so several processes of this host can split the commits between them
+        and a restarted run skips the done ones. the subtrees of each commit
+        are its result in the queue, the process that finds the queue drained records them into the shards
+        in the order of self.commits.
+        :return: True if this process recorded the shards
+        """
+        queue = WorkQueue(queue_path, 'subtrees/{}'.format(self.ast_filename))
+        added = queue.add(self.commits.items())
+        logging.info('{} new commits queued, {}'.format(added, queue.counts()))
+        task = (queue, self, batch, backend, workers, subtree_cache, prefilter)
+        if processes > 1:
+            with ProcessPoolExecutor(processes) as pool:
+                completed = sum(pool.map(subtree_queue_worker, [task] * processes))
+        else:
+            completed = subtree_queue_worker(task)
+        logging.info('{} commits completed by this process, {}'.format(completed, queue.counts()))
+        if not queue.try_finalize():
+            return False
+        recorded = 0
+        for commit_hash, _, subtrees_list in queue.results():
+            # a finalization that died halfway is resumed, the shards already hold part of the commits
+            if subtrees_list and commit_hash in self.commits:
+                self.record_subtrees(commit_hash, subtrees_list)
+                recorded += 1
+        self.finish_subtrees()
+        for commit_hash, error in queue.failed():
+            logging.error('subtree extraction failed on {}: {}'.format(commit_hash, error))
+        print('{} commits recorded from the work queue'.format(recorded))
+        queue.finish_finalize()
+        queue.close()
+        return True
+
+
+def subtree_queue_worker(task):
+    queue, handler, batch, backend, workers, subtree_cache, prefilter = task
+    gumtree = GumTreeDiff(backend=backend, workers=workers)
+    cache = SubtreeCache(subtree_cache, SubTreeExtractor.VERSION) if subtree_cache is not None else None
+    stats = Counter()
+
+    def work(c, p):
+        commit = handler.get_commit(c, p, handler.repo_dir)
+        logging.info('Commit #%s in %s from %s', commit.hash, commit.committer_date, commit.author.name)
+        return handler.commit_subtrees(commit, gumtree, cache, prefilter, stats)
+
+    completed = queue.run(work, batch)
+    gumtree.close()
+    if cache is not None:
+        cache.close()
+    if prefilter != 'off':
+        logging.info('significance pre-filter: {}'.format(dict(stats)))
+    queue.close()
+    return completed
+
+
+def init_subtree_worker(handler, backend, workers, subtree_cache, prefilter):
+    subtree_worker_state.update(
+        handler=handler, prefilter=prefilter,
+        gumtree=GumTreeDiff(backend=backend, workers=workers),
+        cache=SubtreeCache(subtree_cache, SubTreeExtractor.VERSION) if subtree_cache is not None else None)
+
+
+def subtree_worker(task):
+    c, p = task
+    state = subtree_worker_state
+    handler, cache = state['handler'], state['cache']
+    start = time.time()
+    stats = Counter()
+    commit = handler.get_commit(c, p, handler.repo_dir)
+    logging.info('Commit #%s in %s from %s', commit.hash, commit.committer_date, commit.author.name)
+    subtrees_list = handler.commit_subtrees(commit, state['gumtree'], cache, state['prefilter'], stats)
+    cache_counts = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    return commit.hash, subtrees_list, stats, os.getpid(), time.time() - start, cache_counts
 
 
 if __name__ == '__main__':
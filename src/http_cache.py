@@ -0,0 +1,83 @@
+import json
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from lru_store import LRUStore
+
+
+def normalize_url(url):
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+class ResponseCache(LRUStore):
+    """
+    On-disk cache of GitHub responses keyed by normalized URL, with the body, ETag and fetch time.
+    Entries younger than max_age are served locally, older ones are revalidated with If-None-Match
+    (a 304 does not count against the rate limit) and entries older than expire_age are dropped.
+    """
+
+    def __init__(self, path, max_age=30 * 24 * 3600, expire_age=365 * 24 * 3600, max_bytes=1024 ** 3):
+        super().__init__(path, max_bytes)
+        self.max_age = max_age
+        self.expire_age = expire_age
+        self.fresh_hits = 0
+        self.revalidations = 0
+        self.not_modified = 0
+        self.stored = 0
+
+    def lookup(self, url):
+        key = normalize_url(url)
+        value = self.get(key)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        if time.time() - entry['fetched'] > self.expire_age:
+            self.delete(key)
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return entry is not None and time.time() - entry['fetched'] <= self.max_age
+
+    def fresh_body(self, entry):
+        """
+        :param entry: the lookup() of the url
+        :return: the cached body if it can be served without a request, else None
+        """
+        if self.is_fresh(entry):
+            self.fresh_hits += 1
+            return entry['body']
+        return None
+
+    def conditional_headers(self, entry, headers):
+        if entry is not None and entry.get('etag'):
+            self.revalidations += 1
+            return dict(headers, **{'If-None-Match': entry['etag']})
+        return headers
+
+    def update(self, url, status, body, etag, entry=None):
+        """
+        records a response and returns the body to use, the one of the revalidated entry for a 304
+        :param entry: the entry the conditional headers were built from
+        :return: None for a 304 without an entry, the request has to be sent again without the condition
+        """
+        if status == 304:
+            if entry is None:
+                return None
+            self.not_modified += 1
+            entry['fetched'] = time.time()
+            self.put(normalize_url(url), json.dumps(entry).encode('utf-8'))
+            return entry['body']
+        if status == 200:
+            self.stored += 1
+            self.put(normalize_url(url), json.dumps({'body': body, 'etag': etag, 'fetched': time.time()})
+                     .encode('utf-8'))
+        return body
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(fresh_hits=self.fresh_hits, revalidations=self.revalidations,
+                     not_modified=self.not_modified, stored=self.stored)
+        return stats
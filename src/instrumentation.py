@@ -0,0 +1,240 @@
+"""
+Named timers and counters around the hot paths of the pipeline, with periodic snapshots.
+
+    with timer('gumtree'):
+        ...
+    count('commits')
+
+Recording is always on and cheap. configure() (or the --metrics/--prom/--profile flags of the
+scripts) turns on the reporter thread that appends a JSON line per snapshot and/or rewrites a
+Prometheus textfile, with the rates since the previous snapshot and latency percentiles over the
+most recent samples. The configuration is passed on to worker processes through the environment,
+every process reports under its own pid. The opt-in sampling profiler records the stack of the
+other threads every few milliseconds, prefixed with their innermost active timer, and dumps it as
+collapsed stacks (`<pid>.folded`, the input format of flamegraph.pl and speedscope).
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+ENV_VAR = 'APACHEJIT_METRICS'
+RESERVOIR = 2048  # latency samples kept per timer for the percentiles
+internal_threads = set()  # reporter and profiler threads, not sampled
+
+
+class Timer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=RESERVOIR)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+
+class Registry:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.timers = dict()
+        self.counters = Counter()
+        self.active = dict()  # thread id -> stack of active timer names, read by the profiler
+        self.last = {'time': time.time(), 'timers': dict(), 'counters': dict()}
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.observe(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def snapshot(self):
+        """
+        totals, rates since the previous snapshot and p50/p90/p99/max latencies of every timer and counter
+        """
+        now = time.time()
+        with self.lock:
+            elapsed = max(now - self.last['time'], 1e-9)
+            timers = dict()
+            for name, timer in self.timers.items():
+                samples = sorted(timer.samples)
+                previous = self.last['timers'].get(name, (0, 0.0))
+                timers[name] = {'count': timer.count, 'seconds': timer.total,
+                                'rate': (timer.count - previous[0]) / elapsed,
+                                'busy': (timer.total - previous[1]) / elapsed,
+                                'p50': percentile(samples, 0.5), 'p90': percentile(samples, 0.9),
+                                'p99': percentile(samples, 0.99), 'max': timer.max}
+            counters = {name: {'value': value, 'rate': (value - self.last['counters'].get(name, 0)) / elapsed}
+                        for name, value in self.counters.items()}
+            self.last = {'time': now, 'timers': {n: (t.count, t.total) for n, t in self.timers.items()},
+                         'counters': dict(self.counters)}
+        return {'time': now, 'pid': self.pid, 'timers': timers, 'counters': counters}
+
+
+class Profiler:
+    """
+    samples the stacks of the other threads of the process, keyed by their innermost active timer
+    """
+
+    def __init__(self, registry, interval=0.005):
+        self.registry = registry
+        self.interval = interval
+        self.stacks = Counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        internal_threads.add(threading.get_ident())
+        while True:
+            time.sleep(self.interval)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in internal_threads:
+                    continue
+                active = self.registry.active.get(thread_id)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                names.append(active[-1] if active else 'untimed')
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def dump(self, path):
+        with open(path + '.tmp', 'w') as file:
+            for stack, n in self.stacks.most_common():
+                file.write('{} {}\n'.format(stack, n))
+        os.replace(path + '.tmp', path)
+
+
+class Reporter:
+    def __init__(self, registry, config):
+        self.registry = registry
+        self.config = config
+        self.profiler = None
+        if config.get('profile'):
+            os.makedirs(config['profile'], exist_ok=True)
+            self.profiler = Profiler(registry, config.get('profile_interval', 0.005))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.emit)
+
+    def run(self):
+        internal_threads.add(threading.get_ident())
+        while True:
+            time.sleep(self.config.get('interval', 60))
+            self.emit()
+
+    def emit(self):
+        snapshot = self.registry.snapshot()
+        if self.config.get('jsonl'):
+            with open(self.config['jsonl'], 'a') as file:
+                file.write(json.dumps(snapshot) + '\n')
+        if self.config.get('prom'):
+            write_prometheus(snapshot, self.config['prom'].replace('{pid}', str(snapshot['pid'])))
+        if self.profiler is not None:
+            self.profiler.dump(os.path.join(self.config['profile'], '{}.folded'.format(snapshot['pid'])))
+
+
+def write_prometheus(snapshot, path):
+    """
+    rewrites a node_exporter textfile with the snapshot, atomically so the exporter never reads half a file
+    """
+    pid = snapshot['pid']
+    lines = []
+    for name, t in sorted(snapshot['timers'].items()):
+        labels = 'stage="{}",pid="{}"'.format(name, pid)
+        lines.append('apachejit_stage_seconds_total{{{}}} {}'.format(labels, t['seconds']))
+        lines.append('apachejit_stage_calls_total{{{}}} {}'.format(labels, t['count']))
+        for q in ('p50', 'p90', 'p99'):
+            lines.append('apachejit_stage_latency_seconds{{{},quantile="0.{}"}} {}'.format(labels, q[1:], t[q]))
+    for name, c in sorted(snapshot['counters'].items()):
+        lines.append('apachejit_events_total{{name="{}",pid="{}"}} {}'.format(name, pid, c['value']))
+    with open(path + '.tmp', 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+registry = Registry()
+# a spawned worker imports the module afresh and picks the configuration up from the environment
+reporter = Reporter(registry, json.loads(os.environ[ENV_VAR])) if ENV_VAR in os.environ else None
+
+
+def current():
+    """
+    the registry of this process. a forked worker starts from a fresh registry, and starts its own
+    reporter when the parent configured one
+    """
+    global registry, reporter
+    if registry.pid != os.getpid():
+        registry = Registry()
+        reporter = None
+        if ENV_VAR in os.environ:
+            reporter = Reporter(registry, json.loads(os.environ[ENV_VAR]))
+    return registry
+
+
+def configure(jsonl=None, prom=None, profile=None, interval=60, profile_interval=0.005):
+    """
+    :param jsonl: file that gets one JSON snapshot per line
+    :param prom: Prometheus textfile, `{pid}` in the name is replaced by the process id
+    :param profile: directory of the sampling profiler dumps, profiling is off without it
+    """
+    global reporter
+    config = {'jsonl': jsonl, 'prom': prom, 'profile': profile, 'interval': interval,
+              'profile_interval': profile_interval}
+    if not (jsonl or prom or profile):
+        return
+    os.environ[ENV_VAR] = json.dumps(config)  # inherited by spawned and forked workers
+    if reporter is None:
+        reporter = Reporter(current(), config)
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", default=None, type=str, help="JSON lines file of periodic metric snapshots")
+    parser.add_argument("--prom", default=None, type=str, help="Prometheus textfile of the metrics")
+    parser.add_argument("--profile", default=None, type=str, help="directory of sampling profiler dumps")
+    parser.add_argument("--metrics-interval", default=60, type=float, help="seconds between snapshots")
+
+
+def configure_from_args(args):
+    configure(jsonl=args.metrics, prom=args.prom, profile=args.profile, interval=args.metrics_interval)
+
+
+@contextmanager
+def timer(name):
+    reg = current()
+    thread_id = threading.get_ident()
+    stack = reg.active.setdefault(thread_id, [])
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        reg.observe(name, time.perf_counter() - start)
+        stack.pop()
+
+
+def observe(name, seconds):
+    current().observe(name, seconds)
+
+
+def count(name, n=1):
+    current().count(name, n)
@@ -0,0 +1,44 @@
+import com.github.gumtreediff.client.Run;
+
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+
+/**
+ * Runs `gumtree dotdiff` for many file pairs in a single JVM.
+ * Every stdin line holds a tab separated pair of before/after files. The answer is the dot output
+ * of the pair followed by a line `#END OK`, or `#END ERR` when GumTree failed or wrote to stderr.
+ */
+public class GumTreeWorker {
+    public static void main(String[] args) throws IOException {
+        PrintStream out = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] files = line.split("\t");
+            ByteArrayOutputStream dot = new ByteArrayOutputStream();
+            ByteArrayOutputStream err = new ByteArrayOutputStream();
+            System.setOut(new PrintStream(dot, true, "UTF-8"));
+            System.setErr(new PrintStream(err, true, "UTF-8"));
+            boolean ok;
+            try {
+                Run.main(new String[] {"dotdiff", files[0], files[1]});
+                ok = files.length == 2 && err.size() == 0;
+            } catch (Throwable t) {
+                ok = false;
+            }
+            System.out.flush();
+            String result = dot.toString("UTF-8");
+            out.print(result);
+            if (!result.isEmpty() && !result.endsWith("\n"))
+                out.print("\n");
+            out.println(ok ? "#END OK" : "#END ERR");
+            out.flush();
+        }
+    }
+}
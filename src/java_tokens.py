@@ -0,0 +1,52 @@
+import re
+
+# javadoc must come before the other comments: JDT keeps it in the AST, so GumTree reports changes to it
+TOKEN_PATTERN = re.compile(r'''
+    (?P<javadoc>/\*\*(?!/).*?\*/)
+    |(?P<comment>//[^\r\n]*|/\*.*?\*/)
+    |(?P<space>\s+)
+    |(?P<text>"""(?:\\.|[^\\])*?""")
+    |(?P<string>"(?:\\.|[^"\\\r\n])*")
+    |(?P<char>'(?:\\.|[^'\\\r\n])*')
+    |(?P<word>[A-Za-z_$][\w$]*|\d[\w.]*)
+    |(?P<operator>>>>=|<<=|>>=|>>>|\+\+|--|&&|\|\||[=!<>+\-*/&|^%]=|->|::|<<|\.\.\.)
+    |(?P<symbol>.)
+''', re.S | re.X)
+
+
+def tokenize(source, keep_javadoc=True):
+    """
+    Java token stream of source without whitespace and comments
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(source):
+        kind = match.lastgroup
+        if kind == 'space' or kind == 'comment' or (kind == 'javadoc' and not keep_javadoc):
+            continue
+        tokens.append(match.group())
+    return tokens
+
+
+def strip_imports(tokens):
+    stripped, i = [], 0
+    while i < len(tokens):
+        if tokens[i] == 'import' and (i == 0 or tokens[i - 1] in (';', '}')):
+            while i < len(tokens) and tokens[i] != ';':
+                i += 1
+        else:
+            stripped.append(tokens[i])
+        i += 1
+    return stripped
+
+
+def is_significant(before, after, keep_javadoc=True, ignore_imports=False):
+    """
+    False if the two versions only differ in comments and whitespace (and imports with ignore_imports),
+    i.e. changes that leave no red nodes in the GumTree diff.
+    """
+    if before == after:
+        return False
+    b_tokens, a_tokens = tokenize(before, keep_javadoc), tokenize(after, keep_javadoc)
+    if ignore_imports:
+        b_tokens, a_tokens = strip_imports(b_tokens), strip_imports(a_tokens)
+    return b_tokens != a_tokens
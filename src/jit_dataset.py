@@ -0,0 +1,179 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+dataset_path = os.path.join(BASE_DIR, 'dataset')
+
+SPLITS = ['total', 'train', 'test_large', 'test_small']
+FORMAT_VERSION = 1
+BOOL_COLUMNS = ['buggy', 'fix']
+INT64_COLUMNS = ['author_date']
+
+
+def csv_path(split, dataset_dir=dataset_path):
+    return os.path.join(dataset_dir, 'apachejit_{}.csv'.format(split))
+
+
+def split_dir(split, dataset_dir=dataset_path):
+    return os.path.join(dataset_dir, 'columnar', split)
+
+
+def export_split(df, out_dir):
+    """
+    writes one .npy file per column and a meta.json describing them:
+    commit_id as (n, 20) uint8, project as uint8 codes into meta['projects'], buggy and fix
+    bit-packed, year as int16, author_date as int64 and the metrics as int32 or float32
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    n = len(df)
+    meta = {'version': FORMAT_VERSION, 'rows': n, 'columns': dict()}
+    for column in df.columns:
+        values = df[column]
+        if column == 'commit_id':
+            array = np.frombuffer(bytes.fromhex(''.join(values)), dtype=np.uint8).reshape(n, 20)
+            kind = 'sha1'
+        elif column == 'project':
+            categories = pd.Categorical(values)
+            meta['projects'] = list(categories.categories)
+            array = categories.codes.astype(np.uint8)
+            kind = 'category'
+        elif column in BOOL_COLUMNS:
+            array = np.packbits(values.astype(bool).values)
+            kind = 'bits'
+        elif column == 'year':
+            array = values.values.astype(np.int16)
+            kind = 'int16'
+        elif column in INT64_COLUMNS:
+            array = values.values.astype(np.int64)
+            kind = 'int64'
+        elif pd.api.types.is_integer_dtype(values):
+            array = values.values.astype(np.int32)
+            kind = 'int32'
+        else:
+            array = values.values.astype(np.float32)
+            kind = 'float32'
+        np.save(os.path.join(out_dir, column + '.npy'), array)
+        meta['columns'][column] = kind
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def export_dataset(dataset_dir=dataset_path, splits=SPLITS):
+    for split in splits:
+        path = csv_path(split, dataset_dir)
+        if not os.path.exists(path):
+            print('{} not found, skipped.'.format(path))
+            continue
+        df = pd.read_csv(path)
+        export_split(df, split_dir(split, dataset_dir))
+        print('{}: {} rows exported.'.format(split, len(df)))
+
+
+def load_apachejit(split='total', columns=None, years=None, projects=None, as_frame=True,
+                   dataset_dir=dataset_path):
+    """
+    memory-maps a split written by export_dataset
+
+    :param columns: columns to load, all by default
+    :param years: keep only the rows of these years
+    :param projects: keep only the rows of these projects, e.g. 'apache/hive'
+    :param as_frame: a DataFrame with hex commit ids and categorical projects, otherwise a dict of
+                     numpy arrays (memmaps when no rows are filtered out) with raw commit ids and codes
+    """
+    directory = split_dir(split, dataset_dir)
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    n = meta['rows']
+    kinds = meta['columns']
+    columns = list(kinds) if columns is None else list(columns)
+    unknown = [c for c in columns if c not in kinds]
+    if unknown:
+        raise KeyError('unknown columns: {}'.format(unknown))
+
+    def raw(column):
+        array = np.load(os.path.join(directory, column + '.npy'), mmap_mode='r')
+        if kinds[column] == 'bits':
+            array = np.unpackbits(array, count=n).astype(bool)
+        return array
+
+    rows = None
+    if years is not None:
+        rows = np.isin(raw('year'), list(years))
+    if projects is not None:
+        codes = [meta['projects'].index(p) for p in projects if p in meta['projects']]
+        mask = np.isin(raw('project'), codes)
+        rows = mask if rows is None else rows & mask
+    if rows is not None:
+        rows = np.flatnonzero(rows)
+
+    data = dict()
+    for column in columns:
+        array = raw(column)
+        data[column] = array if rows is None else array[rows]
+    if not as_frame:
+        return data
+
+    frame = dict()
+    for column in columns:
+        if kinds[column] == 'sha1':
+            hexes = np.ascontiguousarray(data[column]).tobytes().hex()
+            frame[column] = [hexes[i:i + 40] for i in range(0, len(hexes), 40)]
+        elif kinds[column] == 'category':
+            frame[column] = pd.Categorical.from_codes(data[column], meta['projects'])
+        else:
+            frame[column] = data[column]
+    return pd.DataFrame(frame, columns=columns)
+
+
+def measure(task):
+    """
+    loads a split in a fresh worker and returns the load time and the peak RSS in MB
+    """
+    loader, split, dataset_dir = task
+    start = time.perf_counter()
+    if loader == 'csv':
+        df = pd.read_csv(csv_path(split, dataset_dir))
+    elif loader == 'columnar':
+        df = load_apachejit(split, dataset_dir=dataset_dir)
+    else:
+        df = load_apachejit(split, as_frame=False, dataset_dir=dataset_dir)
+    elapsed = time.perf_counter() - start
+    rows = len(df) if loader != 'arrays' else len(df['commit_id'])
+    return rows, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(dataset_dir=dataset_path, splits=SPLITS, repeat=3):
+    # spawned rather than forked, a forked worker's peak RSS would include the memory of this process
+    context = multiprocessing.get_context('spawn')
+    for split in splits:
+        if not os.path.exists(csv_path(split, dataset_dir)):
+            continue
+        for loader in ['csv', 'columnar', 'arrays']:
+            results = []
+            for _ in range(repeat):
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    results.append(pool.map(measure, [(loader, split, dataset_dir)])[0])
+            rows = results[0][0]
+            best = min(r[1] for r in results)
+            rss = max(r[2] for r in results)
+            print('{:<11} {:<9} {:>7} rows  {:8.3f} sec  {:8.1f} MB peak RSS'.format(split, loader, rows, best, rss))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=dataset_path, type=str, help="directory of the apachejit csv files")
+    parser.add_argument("--splits", nargs='*', default=SPLITS, help="")
+    parser.add_argument("--benchmark", action='store_true', help="compare load time and RSS against the csv files")
+    args = parser.parse_args()
+
+    export_dataset(args.dataset, args.splits)
+    if args.benchmark:
+        benchmark(args.dataset, args.splits)
+    print('finished.')
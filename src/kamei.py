@@ -0,0 +1,159 @@
+import argparse
+import csv
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from multiprocessing import Pool
+from pathlib import Path
+
+import pandas as pd
+
+from git_stream import stream_numstat
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+data_path = os.path.join(BASE_DIR, 'data')
+
+COLUMNS = ['commit_id', 'author_date', 'la', 'ld', 'nf', 'nd', 'ns', 'ent',
+           'ndev', 'age', 'nuc', 'aexp', 'arexp', 'asexp']
+
+
+class KameiMetrics:
+    """
+    Kamei et al. JIT metrics of every commit of a repo, computed in one chronological pass over
+    `git log --numstat` with incremental per-file and per-developer state:
+
+    la, ld: lines added and deleted, nf: modified files, nd: distinct directories, ns: distinct
+    subsystems (top level directories), ent: entropy of the modified lines over the files.
+    ndev, age, nuc: developers that changed a file before, days since its last change and number of
+    its earlier changes, averaged over the modified files.
+    aexp: earlier commits of the author, arexp: the same weighted by 1 / (1 + age in years),
+    asexp: earlier commits of the author in the modified subsystems, averaged over the subsystems.
+    """
+    LOG_FORMAT = '--format=%x00%H%x00%at%x00%ae%x00%an'
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.developers = dict()  # author -> int id
+        self.files = dict()  # path -> [last change time, number of changes, set of developer ids]
+        self.exp = []  # developer id -> number of commits
+        self.exp_years = []  # developer id -> {year: number of commits}
+        self.exp_subsystems = []  # developer id -> {subsystem: number of commits}
+
+    def developer(self, email, name):
+        key = (email or name).lower()
+        dev = self.developers.get(key)
+        if dev is None:
+            dev = self.developers[key] = len(self.exp)
+            self.exp.append(0)
+            self.exp_years.append(dict())
+            self.exp_subsystems.append(dict())
+        return dev
+
+    @staticmethod
+    def subsystem(path):
+        return path.split('/', 1)[0] if '/' in path else ''
+
+    def commit_metrics(self, author_date, dev, files):
+        la = sum(f[0] for f in files)
+        ld = sum(f[1] for f in files)
+        nf = len(files)
+        nd = len(set(os.path.dirname(f[3]) for f in files))
+        subsystems = set(self.subsystem(f[3]) for f in files)
+        ns = len(subsystems)
+        modified = la + ld
+        ent = 0.0
+        if modified > 0:
+            for added, deleted, _, _ in files:
+                p = (added + deleted) / modified
+                if p > 0:
+                    ent -= p * math.log2(p)
+        ndev, age, nuc = 0, 0.0, 0
+        for _, _, old, _ in files:
+            state = self.files.get(old)
+            if state is not None:
+                age += max(author_date - state[0], 0) / 86400
+                nuc += state[1]
+                ndev += len(state[2])
+        year = datetime.fromtimestamp(author_date, timezone.utc).year
+        arexp = sum(n / (1 + max(year - y, 0)) for y, n in self.exp_years[dev].items())
+        asexp = sum(self.exp_subsystems[dev].get(s, 0) for s in subsystems) / ns if ns else 0
+        return [la, ld, nf, nd, ns, ent, ndev / nf if nf else 0, age / nf if nf else 0, nuc / nf if nf else 0,
+                self.exp[dev], arexp, asexp]
+
+    def update(self, author_date, dev, files):
+        year = datetime.fromtimestamp(author_date, timezone.utc).year
+        self.exp[dev] += 1
+        self.exp_years[dev][year] = self.exp_years[dev].get(year, 0) + 1
+        for s in set(self.subsystem(f[3]) for f in files):
+            self.exp_subsystems[dev][s] = self.exp_subsystems[dev].get(s, 0) + 1
+        for _, _, old, new in files:
+            state = self.files.pop(old, None) if old != new else self.files.get(new)
+            if state is None:
+                state = [author_date, 0, set()]
+            state[0] = author_date
+            state[1] += 1
+            state[2].add(dev)
+            self.files[new] = state
+
+    def run(self, out_file, commits=None):
+        """
+        writes the metrics of the repo's history (restricted to `commits` if given) to out_file
+        """
+        count = 0
+        with open(out_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(COLUMNS)
+            for (h, at, email, name), files in stream_numstat(self.repo, ['--reverse', '-M', self.LOG_FORMAT, 'HEAD']):
+                author_date = int(at)
+                dev = self.developer(email, name)
+                if commits is None or h in commits:
+                    writer.writerow([h, author_date] + self.commit_metrics(author_date, dev, files))
+                self.update(author_date, dev, files)
+                count += 1
+                if count % 10000 == 0:
+                    logging.info('{}: {} commits processed'.format(self.repo, count))
+        logging.info('{}: {} commits processed'.format(self.repo, count))
+        return out_file
+
+
+def kamei_worker(task):
+    repo, out_file, commits = task
+    return KameiMetrics(repo).run(out_file, commits)
+
+
+def compute_metrics(repos, out_file, commits=None, workers=1):
+    """
+    one streaming pass per repo, in parallel, merged into out_file in the order of repos
+    """
+    parts_dir = os.path.join(os.path.dirname(out_file), 'kamei_parts')
+    Path(parts_dir).mkdir(parents=True, exist_ok=True)
+    tasks = [(r, os.path.join(parts_dir, '{}.csv'.format(os.path.basename(os.path.normpath(r)))), commits)
+             for r in repos]
+    with Pool(max(workers, 1)) as pool:
+        parts = pool.map(kamei_worker, tasks, chunksize=1)
+    pd.concat([pd.read_csv(p) for p in parts]).drop_duplicates('commit_id') \
+        .to_csv(out_file, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repos", nargs='*', default=None, help="repos to mine, all of repos/ by default")
+    parser.add_argument("--commits", default=None, type=str, help="csv with a commit_id column to restrict the output")
+    parser.add_argument("--out", default=os.path.join(data_path, 'apache_metrics_kamei.csv'), type=str, help="")
+    parser.add_argument("--workers", default=1, type=int, help="number of repos mined in parallel")
+    args = parser.parse_args()
+
+    Path("logs/").mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S',
+                        handlers=[
+                            RotatingFileHandler(filename='logs/kamei.log', maxBytes=5 * 1024 * 1024,
+                                                backupCount=5)])
+    repo_dir = os.path.join(BASE_DIR, 'repos')
+    repos = args.repos or sorted(os.path.join(repo_dir, r) for r in os.listdir(repo_dir)
+                                 if os.path.isdir(os.path.join(repo_dir, r)))
+    commits = set(pd.read_csv(args.commits)['commit_id']) if args.commits else None
+    compute_metrics(repos, args.out, commits, args.workers)
+    print('finished.')
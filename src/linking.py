@@ -0,0 +1,196 @@
+import argparse
+import io
+import logging
+import os
+import time
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+import pandas as pd
+
+from commit_index import CommitIndex
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+data_path = os.path.join(BASE_DIR, 'data')
+
+YEARS = [str(y) for y in range(2010, 2020)]
+PROJECT_RENAMES = {'apache/amq': 'apache/activemq', 'apache/hdfs': 'apache/hadoop-hdfs',
+                   'apache/mapreduce': 'apache/hadoop-mapreduce'}
+
+
+class LinkingPipeline:
+    """
+    data_linking_filtering.ipynb as a module: links the fixed issues to their fixing and
+    bug-inducing commits, filters the links and writes apachejava.csv.
+    Every step is a merge, groupby or isin instead of the per-row loops of the notebook.
+    """
+
+    def __init__(self, data_dir=data_path, repo_dir=os.path.join(BASE_DIR, 'repos'), years=YEARS):
+        self.data_dir = data_dir
+        self.repo_dir = repo_dir
+        self.years = years
+        self.timings = []
+
+    def timed(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        self.timings.append((name, elapsed))
+        logging.info('{}: {:.3f} sec'.format(name, elapsed))
+        return result
+
+    def read_issues(self):
+        df = pd.concat([pd.read_csv(os.path.join(self.data_dir, y + '.csv'), index_col=None) for y in self.years],
+                       axis=0, ignore_index=True)
+        # the notebook never assigned the drop_duplicates on 'Issue key', duplicates are kept
+        df['project'] = df['Issue key'].str.split('-').str[0]
+        return df[df['project'] != 'ROCKETMQ']
+
+    def read_found(self, projects):
+        found = []
+        for p in projects:
+            f = pd.read_csv(os.path.join(self.data_dir, '{}.csv'.format(p)))
+            f['project'] = p
+            found.append(f)
+        return pd.concat(found)
+
+    def read_links(self, projects):
+        return pd.concat([pd.read_csv(os.path.join(self.data_dir, 'commit_links_{}.csv'.format(p)))
+                          for p in projects])
+
+    @staticmethod
+    def filter_dates(found, df, commit_links):
+        """
+        keeps the links whose bug-inducing commit is older than both the bug report and the fix
+        """
+        fix_bugreport = pd.merge(found, df[['Issue key', 'Created']], how='inner',
+                                 left_on='issue_key', right_on='Issue key')[['commit_id', 'Created']]
+        links = pd.merge(commit_links, fix_bugreport, how='inner', left_on='fix_hash', right_on='commit_id') \
+            .drop_duplicates(['fix_hash', 'bug_hash'])
+        created = pd.to_datetime(links['Created'])
+        bug_date = pd.to_datetime(links['bug_date'], unit='s')
+        fix_date = pd.to_datetime(links['fix_date'], unit='s')
+        links = links.assign(Created=created, bug_date=bug_date, fix_date=fix_date)
+        return links[(links['bug_date'] < links['Created']) & (links['bug_date'] < links['fix_date'])]
+
+    @staticmethod
+    def filter_counts(links, column):
+        """
+        drops the links of the commits in `column` with more than mean + std links
+        """
+        counts = links.groupby(column).size()
+        max_count = int(counts.mean() + counts.std())
+        return links[links[column].isin(counts.index[counts <= max_count])]
+
+    @staticmethod
+    def repo_names(projects):
+        return ('apache/' + projects.str.lower()).replace(PROJECT_RENAMES)
+
+    def label(self, found, commit_links, f3):
+        java_buggy = f3[['bug_hash', 'project']].drop_duplicates('bug_hash').copy()
+        java_buggy['buggy'] = True
+        java_buggy['project'] = self.repo_names(java_buggy['project'])
+        java_buggy = java_buggy.rename(columns={'bug_hash': 'commit_id'})
+
+        # fixing commits without bug-inducing commits based on SZZ
+        remain = found[~found['commit_id'].isin(commit_links['fix_hash'])]
+        remain = remain[['commit_id', 'project']].drop_duplicates().copy()
+        remain['project'] = self.repo_names(remain['project'])
+        remain['fix'] = True
+        remain['buggy'] = remain['commit_id'].isin(java_buggy['commit_id'])
+        java_buggy['fix'] = java_buggy['commit_id'].isin(found['commit_id'])
+
+        return pd.concat([java_buggy, remain]).sort_values('commit_id').drop_duplicates('commit_id', keep='first')
+
+    def commit_dates(self, apachejava):
+        """
+        committer dates from one CommitIndex per repo, hadoop-* commits fall back to the hadoop repo
+        """
+        indexes = dict()
+
+        def index(repo):
+            if repo not in indexes:
+                path = os.path.join(self.repo_dir, repo)
+                indexes[repo] = CommitIndex(path) if os.path.isdir(path) else None
+            return indexes[repo]
+
+        dates = dict()
+        for project, commits in apachejava.groupby('project')['commit_id']:
+            repo = project.split('/')[1]
+            hashes = commits.tolist()
+            found = index(repo).lookup(hashes) if index(repo) is not None else dict()
+            missing = [h for h in hashes if h not in found]
+            if missing:
+                found.update(index(repo.split('-')[0]).lookup(missing))
+            dates.update((h, found[h][0]) for h in hashes)
+        for idx in indexes.values():
+            if idx is not None:
+                idx.close()
+        return apachejava['commit_id'].map(dates).values
+
+    def run(self, with_dates=True):
+        df = self.timed('read issues', self.read_issues)
+        projects = df['project'].sort_values().unique()
+        found = self.timed('read found', self.read_found, projects)
+
+        # remove MESOS because of bad commit message formats
+        df = df[df['project'] != 'MESOS']
+        found = found[found['project'] != 'MESOS']
+        projects = df['project'].sort_values().unique()
+
+        commit_links = self.timed('read links', self.read_links, projects)
+        links = self.timed('date filter', self.filter_dates, found, df, commit_links)
+        f2 = self.timed('fixcount filter', self.filter_counts, links, 'fix_hash')
+        f3 = self.timed('bugcount filter', self.filter_counts, f2, 'bug_hash')
+        logging.info('links: {} -> {} -> {} -> {}'.format(len(commit_links), len(links), len(f2), len(f3)))
+        apachejava = self.timed('label', self.label, found, commit_links, f3)
+        if with_dates:
+            apachejava['date'] = self.timed('commit dates', self.commit_dates, apachejava)
+        return apachejava
+
+
+def compare(result, expected_file):
+    expected = pd.read_csv(expected_file)
+    result = pd.read_csv(io.StringIO(result.to_csv(index=False)))
+    columns = [c for c in expected.columns if c in result.columns]
+    try:
+        pd.testing.assert_frame_equal(result[columns].reset_index(drop=True),
+                                      expected[columns].reset_index(drop=True))
+    except AssertionError as e:
+        logging.error('output differs from {}: {}'.format(expected_file, e))
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default=data_path, type=str, help="directory of the issue and link csv files")
+    parser.add_argument("--repos", default=os.path.join(BASE_DIR, 'repos'), type=str, help="")
+    parser.add_argument("--out", default=os.path.join(data_path, 'apachejava.csv'), type=str, help="")
+    parser.add_argument("--no-dates", action='store_true', help="skip the commit date lookup")
+    parser.add_argument("--verify", default=None, type=str, help="csv to compare the output with")
+    parser.add_argument("--benchmark", default=0, type=int, help="time the pipeline over this many runs")
+    args = parser.parse_args()
+
+    Path("logs/").mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S',
+                        handlers=[
+                            RotatingFileHandler(filename='logs/linking.log', maxBytes=5 * 1024 * 1024,
+                                                backupCount=5)])
+    pipeline = LinkingPipeline(args.data, args.repos)
+    if args.benchmark:
+        totals = []
+        for _ in range(args.benchmark):
+            pipeline.timings = []
+            pipeline.run(not args.no_dates)
+            totals.append(sum(t for _, t in pipeline.timings))
+        for name, elapsed in pipeline.timings:
+            print('{:<16} {:8.3f} sec'.format(name, elapsed))
+        print('{} runs, best {:.3f} sec, mean {:.3f} sec'.format(len(totals), min(totals), sum(totals) / len(totals)))
+    else:
+        apachejava = pipeline.run(not args.no_dates)
+        apachejava.to_csv(args.out, index=False)
+        if args.verify and not compare(apachejava, args.verify):
+            print('output differs from {}, see logs/linking.log'.format(args.verify))
+        print('finished.')
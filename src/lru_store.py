@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import time
+import zlib
+
+
+class LRUStore:
+    """
+    A size-bounded key/value store on top of SQLite. Values are compressed bytes, entries are evicted
+    in least-recently-used order once the total size exceeds max_bytes. Safe to share between processes.
+    """
+    EVICT_EVERY = 100
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                          '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access)')
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+        return zlib.decompress(row[0])
+
+    def put(self, key, value):
+        blob = zlib.compress(value)
+        self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                          (key, blob, len(blob), time.time()))
+        self.puts += 1
+        if self.puts % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def delete(self, key):
+        self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def size(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        removed, freed = [], 0
+        for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY last_access'):
+            removed.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany('DELETE FROM entries WHERE key = ?', removed)
+        return len(removed)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0],
+                'bytes': self.size()}
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,133 @@
+import argparse
+import logging
+import os
+import re
+import subprocess
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+import pandas as pd
+
+from collector import GithubCollector, dump_data, read_issue_keys
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+data_path = os.path.join(BASE_DIR, 'data')
+
+# anything shaped like a Jira key, the digits must not continue (HIVE-12 does not match HIVE-123)
+KEY_PATTERN = re.compile('(?<![A-Za-z0-9])([A-Za-z][A-Za-z0-9_]+-[0-9]+)(?![0-9])')
+
+
+class OfflineLinker:
+    """
+    Links issue keys to commits by scanning the commit messages of the local clones under repos/
+    instead of one GitHub search per key. Every message is read once and every key-shaped token is
+    looked up in the set of known keys, so a repo costs one `git log` however many keys there are.
+    """
+
+    def __init__(self):
+        self.repo_dir = os.path.join(BASE_DIR, 'repos')
+        self.proj_repo = GithubCollector.PROJ_REPO
+        self.found = {}
+        self.notfound = []
+        Path("logs/").mkdir(parents=True, exist_ok=True)
+        logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                            level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S',
+                            handlers=[
+                                RotatingFileHandler(filename='logs/offline_linking.log', maxBytes=5 * 1024 * 1024,
+                                                    backupCount=5)])
+
+    @staticmethod
+    def stream_messages(repo):
+        """
+        yields (hash, message) of the commits reachable from HEAD, newest first
+        """
+        log = subprocess.Popen(['git', '-C', repo, 'log', '-z', '--format=%H%n%B', 'HEAD'],
+                               stdout=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='replace')
+        buffer = ''
+        while True:
+            chunk = log.stdout.read(1 << 20)
+            if not chunk:
+                break
+            records = (buffer + chunk).split('\0')
+            buffer = records.pop()
+            for record in records:
+                h, _, message = record.partition('\n')
+                yield h, message
+        if buffer:
+            h, _, message = buffer.partition('\n')
+            yield h, message
+        log.wait()
+
+    def scan_repo(self, repo, keys):
+        """
+        key -> newest commit of repo whose message mentions it
+        """
+        links = {}
+        for h, message in self.stream_messages(repo):
+            for match in KEY_PATTERN.findall(message):
+                key = match.upper()
+                if key in keys and key not in links:
+                    links[key] = h
+        return links
+
+    def start(self, issue_keys, project):
+        self.project = project
+        self.found, self.notfound = {}, []
+        keys = list(dict.fromkeys(issue_keys))
+        remaining = set(keys)
+        links = {}
+        # like the GitHub search, a later repo is only used for keys the earlier ones did not have
+        for r in self.proj_repo[project]:
+            repo = os.path.join(self.repo_dir, r.split('/')[-1])
+            if not os.path.isdir(repo) or not remaining:
+                continue
+            repo_links = self.scan_repo(repo, remaining)
+            logging.info('{}: {} of {} keys found'.format(r, len(repo_links), len(remaining)))
+            links.update(repo_links)
+            remaining -= set(repo_links)
+        for k in keys:
+            if k in links:
+                self.found[k] = links[k]
+            else:
+                self.notfound.append(k)
+        dump_data(self.project, self.found, self.notfound)
+
+    @staticmethod
+    def read_links(project):
+        """
+        links of the GitHub search in `<PROJECT>.csv`, read before start() writes `<project>.csv`
+        (the same file on case-insensitive filesystems)
+        """
+        return dict(pd.read_csv(os.path.join(data_path, '{}.csv'.format(project)))[['issue_key', 'commit_id']]
+                    .itertuples(index=False))
+
+    def report(self, api):
+        """
+        compares the offline links with the API derived ones
+        """
+        keys = set(api) | set(self.found)
+        rows = []
+        for k in sorted(keys):
+            a, o = api.get(k), self.found.get(k)
+            status = 'same' if a == o else 'only_api' if o is None else 'only_offline' if a is None else 'different'
+            rows.append((k, a, o, status))
+        df = pd.DataFrame(rows, columns=['issue_key', 'api_commit', 'offline_commit', 'status'])
+        df.to_csv(os.path.join(data_path, 'link_report_{}.csv'.format(self.project)), index=False)
+        summary = df.groupby('status').size().to_dict()
+        print('{}: {}'.format(self.project, summary))
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", nargs='+', default=None, type=str, help="")
+    parser.add_argument("--report", action='store_true', help="compare with the GitHub search results")
+    args = parser.parse_args()
+
+    linker = OfflineLinker()
+    for project in args.project:
+        api_links = linker.read_links(project) if args.report else None
+        linker.start(read_issue_keys(project), project)
+        if args.report:
+            linker.report(api_links)
+    print('finished.')
@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import time
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+import pandas as pd
+
+from collector import GithubCollector
+from dataset_builder import DatasetBuilder
+import instrumentation
+from gitminer import GitMiner
+from gumtree import RunHandler
+from kamei import compute_metrics
+from linking import LinkingPipeline
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+data_path = os.path.join(BASE_DIR, 'data')
+dataset_path = os.path.join(BASE_DIR, 'dataset')
+
+STATE_FILE = os.path.join(data_path, 'refresh_state.json')
+STEPS = ['issues', 'szz', 'linking', 'clean', 'filter', 'subtrees', 'metrics', 'merge']
+
+
+class DatasetRefresh:
+    """
+    brings an existing build up to date with the history added since the last run.
+
+    per repo watermarks (last HEAD and its date) and the fix commits already run through SZZ are kept in
+    refresh_state.json. each step only touches the delta and is safe to rerun after an interruption:
+    issues searches the issue keys that are neither found nor notfound yet, szz runs on the fixes not
+    processed before, clean lists the commits between a repo's watermark and its HEAD, filter, subtrees
+    and metrics skip what they already have, and merge appends the commits missing from the splits.
+    the link filters and the labels are recomputed over the whole data because their thresholds are
+    dataset wide statistics, a new fix can turn an existing commit buggy.
+    """
+
+    def __init__(self, workers=1, blame_cache=None, search_cache=None, subtree_options=None):
+        self.workers = workers
+        self.blame_cache = blame_cache
+        self.search_cache = search_cache
+        self.subtree_options = subtree_options or dict()
+        self.miner = GitMiner(blame_cache=blame_cache)
+        self.state = self.load_state()
+
+    @staticmethod
+    def load_state():
+        if os.path.isfile(STATE_FILE):
+            with open(STATE_FILE) as file:
+                return json.load(file)
+        return {'repos': dict(), 'szz_done': None}
+
+    def save_state(self):
+        with open(STATE_FILE + '.tmp', 'w') as file:
+            json.dump(self.state, file, indent=1)
+        os.replace(STATE_FILE + '.tmp', STATE_FILE)
+
+    @staticmethod
+    def issue_years():
+        return sorted(f[:-len('.csv')] for f in os.listdir(data_path) if re.match('^[0-9]{4}\\.csv$', f))
+
+    @staticmethod
+    def read_csv(name, columns):
+        path = os.path.join(data_path, name)
+        return pd.read_csv(path) if os.path.isfile(path) else pd.DataFrame(columns=columns)
+
+    def read_found(self):
+        found = []
+        for p in self.miner.proj_repo:
+            f = self.read_csv('{}.csv'.format(p), ['issue_key', 'commit_id'])
+            f['project'] = p
+            found.append(f)
+        return pd.concat(found, ignore_index=True)
+
+    def repos(self):
+        return [os.path.join(self.miner.repo_dir, r.split('/')[-1]) for r in
+                dict.fromkeys(c for sublist in self.miner.proj_repo.values() for c in sublist)]
+
+    def pull(self):
+        for repo in self.repos():
+            subprocess.run(['git', '-C', repo, 'pull', '--ff-only', '--quiet'], check=True)
+
+    def issues(self):
+        """
+        searches the fixing commits of the issue keys that were never searched before
+        """
+        issues = pd.concat([pd.read_csv(os.path.join(data_path, y + '.csv')) for y in self.issue_years()],
+                           ignore_index=True)
+        issues['project'] = issues['Issue key'].str.split('-').str[0]
+        found = self.read_found()
+        if self.state['szz_done'] is None:  # first refresh, the fixes of the initial build are done
+            self.state['szz_done'] = sorted(set(found['commit_id']))
+            self.save_state()
+        notfound = self.read_csv('notfound.csv', ['project', 'issue_key'])
+        searched = set(found['issue_key']) | set(notfound['issue_key'])
+        new = issues[~issues['Issue key'].isin(searched) & issues['project'].isin(self.miner.proj_repo)] \
+            .drop_duplicates('Issue key')
+        logging.info('{} new issues to search'.format(len(new)))
+        if len(new) == 0:
+            return
+        github = GithubCollector(cache_path=self.search_cache)
+        for project, keys in new.groupby('project')['Issue key']:
+            previous = found[found['project'] == project]
+            github.found = dict(zip(previous['issue_key'], previous['commit_id']))
+            github.notfound = []
+            github.found_file = '{}.csv'.format(project)  # the file read_found reads
+            github.start(keys.tolist(), project)
+            logging.info('{}: {} fixes found in total'.format(project, len(github.found)))
+
+    def szz(self):
+        """
+        runs SZZ on the fixing commits found since the last refresh and appends their links
+        """
+        found = self.read_found()
+        done = set(self.state['szz_done'] or found['commit_id'])
+        new = found[~found['commit_id'].isin(done)]
+        bug_fix = []
+        for project, project_df in new.groupby('project'):
+            links_file = os.path.join(data_path, 'commit_links_{}.csv'.format(project))
+            data = self.miner.run_collector(project_df, project, workers=self.workers)
+            links = pd.concat([self.read_csv('commit_links_{}.csv'.format(project), list(data)),
+                               pd.DataFrame(data)], ignore_index=True)
+            links.to_csv(links_file, index=False)
+            bug_fix += project_df['commit_id'].tolist() + data['bug_hash']
+            logging.info('{}: {} new fixes, {} new links'.format(project, len(project_df), len(data['fix_hash'])))
+        if bug_fix:
+            all_commits = pd.concat([self.read_csv('bug_fix_all.csv', ['commit_id']),
+                                     pd.DataFrame({'commit_id': bug_fix})], ignore_index=True)
+            all_commits.drop_duplicates('commit_id').to_csv(os.path.join(data_path, 'bug_fix_all.csv'), index=False)
+        self.state['szz_done'] = sorted(done | set(new['commit_id']))
+        self.save_state()
+
+    def linking(self):
+        apachejava = LinkingPipeline(data_path, self.miner.repo_dir, self.issue_years()).run()
+        apachejava.to_csv(os.path.join(data_path, 'apachejava.csv'), index=False)
+
+    def clean(self):
+        """
+        appends the commits between each repo's watermark and its HEAD that are not bug or fix commits
+        to clean.csv, the delta also goes to clean_delta.csv for the filter step
+        """
+        bug_fix = set(self.read_csv('bug_fix_all.csv', ['commit_id'])['commit_id'])
+        delta = []
+        heads = dict()
+        for repo in self.repos():
+            name = os.path.basename(repo)
+            watermark = self.state['repos'].get(name)
+            head = subprocess.run(['git', '-C', repo, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                  check=True, universal_newlines=True).stdout.strip()
+            if watermark is not None and watermark['head'] == head:
+                continue
+            # the initial build covered everything up to GitMiner.CLEAN_TO
+            revisions = ['{}..HEAD'.format(watermark['head'])] if watermark is not None \
+                else ['--since={}'.format(self.miner.CLEAN_TO), 'HEAD']
+            out = subprocess.run(['git', '-C', repo, 'log', '--reverse', '--format=%H %ct', *revisions],
+                                 stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            rows = [line.split() for line in out.splitlines()]
+            delta += [(h, 'apache/{}'.format(name), int(date)) for h, date in rows if h not in bug_fix]
+            heads[name] = {'head': head, 'date': int(rows[-1][1]) if rows else None}
+        delta = pd.DataFrame(delta, columns=['commit_id', 'project', 'commit_date']).drop_duplicates()
+        clean = pd.concat([self.read_csv('clean.csv', list(delta.columns)), delta], ignore_index=True)
+        clean.drop_duplicates().to_csv(os.path.join(data_path, 'clean.csv'), index=False)
+        # pending deltas of an interrupted refresh are kept until the filter step has run
+        pending = self.read_csv('clean_delta.csv', list(delta.columns))
+        pd.concat([pending, delta], ignore_index=True).drop_duplicates() \
+            .to_csv(os.path.join(data_path, 'clean_delta.csv'), index=False)
+        self.state['repos'].update(heads)
+        self.save_state()
+        logging.info('{} new clean candidates'.format(len(delta)))
+
+    def filter(self):
+        delta_file = os.path.join(data_path, 'clean_delta.csv')
+        if not os.path.isfile(delta_file):
+            return
+        handler = RunHandler(commit_file='clean_delta.csv', ast_filename='subtrees_clean_color',
+                             already_file='keys_clean_ast.csv', types=['.java'],
+                             store=self.subtree_options.get('store', 'json'), repo_dir=self.miner.repo_dir,
+                             load_shards=False)
+        handler.filter_commits_bulk(repo_dir=self.miner.repo_dir, out_file='clean_filtered_delta.csv')
+        filtered = pd.concat([self.read_csv('clean_filtered.csv', ['commit_id', 'project', 'date']),
+                              self.read_csv('clean_filtered_delta.csv', ['commit_id', 'project', 'date'])],
+                             ignore_index=True)
+        filtered.drop_duplicates('commit_id').to_csv(os.path.join(data_path, 'clean_filtered.csv'), index=False)
+        os.remove(delta_file)
+        os.remove(os.path.join(data_path, 'clean_filtered_delta.csv'))
+
+    def subtrees(self):
+        # RunHandler skips the commits of its already_file, so only the new ones are diffed
+        for commit_file, ast_filename, already_file in (
+                ('apachejava.csv', 'subtrees_apachejava_color', 'keys_apachejava_ast.csv'),
+                ('clean_filtered.csv', 'subtrees_clean_color', 'keys_clean_ast.csv')):
+            handler = RunHandler(commit_file=commit_file, ast_filename=ast_filename,
+                                 already_file=already_file, types=['.java'],
+                                 store=self.subtree_options.get('store', 'json'), repo_dir=self.miner.repo_dir)
+            handler.store_subtrees(backend=self.subtree_options.get('backend', 'process'),
+                                   subtree_cache=self.subtree_options.get('subtree_cache'),
+                                   processes=self.workers)
+
+    def labeled_commits(self):
+        """
+        buggy, fix and clean commits with subtrees and their year, like dataset_construction.ipynb
+        """
+        return DatasetBuilder(data_path, dataset_path).labeled_commits(last_year=None)
+
+    def metrics(self):
+        metrics_file = os.path.join(data_path, 'apache_metrics_kamei.csv')
+        metrics = self.read_csv('apache_metrics_kamei.csv', ['commit_id'])
+        commits = set(self.labeled_commits()['commit_id']) - set(metrics['commit_id'])
+        if not commits:
+            return
+        delta_file = os.path.join(data_path, 'apache_metrics_kamei_delta.csv')
+        compute_metrics(self.repos(), delta_file, commits, self.workers)
+        pd.concat([metrics, pd.read_csv(delta_file)], ignore_index=True).drop_duplicates('commit_id') \
+            .to_csv(metrics_file, index=False)
+        os.remove(delta_file)
+        logging.info('metrics of {} new commits'.format(len(commits)))
+
+    def merge(self):
+        """
+        appends the new commits to apachejit_total and apachejit_test_large (they are the most recent
+        history) and updates the labels of the commits that a new fix linked as buggy in every split
+        """
+        commits = self.labeled_commits()
+        metrics = pd.read_csv(os.path.join(data_path, 'apache_metrics_kamei.csv'))
+        buggy = set(commits[commits['buggy']]['commit_id'])
+        fix = set(commits[commits['fix']]['commit_id'])
+        total_file = os.path.join(dataset_path, 'apachejit_total.csv')
+        total = pd.read_csv(total_file)
+        new = commits[~commits['commit_id'].isin(total['commit_id'])]
+        new = pd.merge(new, metrics).drop(columns=['date']).sort_values('year')[list(total.columns)]
+        for split in ['total', 'train', 'test_large', 'test_small']:
+            path = os.path.join(dataset_path, 'apachejit_{}.csv'.format(split))
+            if not os.path.isfile(path):
+                continue
+            df = total if split == 'total' else pd.read_csv(path)
+            relabeled = (df['commit_id'].isin(buggy) & ~df['buggy']).sum()
+            df['buggy'] = df['buggy'] | df['commit_id'].isin(buggy)
+            df['fix'] = df['fix'] | df['commit_id'].isin(fix)
+            if split in ('total', 'test_large'):
+                df = pd.concat([df, new], ignore_index=True)
+            df.to_csv(path, index=False)
+            logging.info('{}: {} commits added, {} relabeled buggy'
+                         .format(split, len(new) if split in ('total', 'test_large') else 0, relabeled))
+
+    def run(self, steps=STEPS, pull=False):
+        if pull:
+            self.pull()
+        for step in steps:
+            start = time.time()
+            with instrumentation.timer('refresh_' + step):
+                getattr(self, step)()
+            logging.info('step {} done in {:.1f} sec'.format(step, time.time() - start))
+            print('{} done.'.format(step))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", nargs='*', default=STEPS, choices=STEPS, help="steps to run, in order")
+    parser.add_argument("--pull", action='store_true', help="fast-forward the repos before refreshing")
+    parser.add_argument("--workers", default=1, type=int, help="")
+    parser.add_argument("--blame-cache", default=None, type=str, help="path of the persistent blame cache")
+    parser.add_argument("--search-cache", default=None, type=str, help="path of the search response cache")
+    parser.add_argument("--subtree-cache", default=None, type=str, help="path of the subtree cache")
+    parser.add_argument("--store", default='json', choices=['json', 'append'], help="subtree shard format")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+
+    Path("logs/").mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S',
+                        handlers=[
+                            RotatingFileHandler(filename='logs/refresh.log', maxBytes=5 * 1024 * 1024,
+                                                backupCount=5)])
+    refresh = DatasetRefresh(workers=args.workers, blame_cache=args.blame_cache, search_cache=args.search_cache,
+                             subtree_options={'store': args.store, 'subtree_cache': args.subtree_cache})
+    refresh.run(args.steps, pull=args.pull)
+    print('finished.')
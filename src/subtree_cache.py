@@ -0,0 +1,40 @@
+import hashlib
+import json
+
+from lru_store import LRUStore
+
+
+class SubtreeCache(LRUStore):
+    """
+    Persistent cache of the (features, edges, colors) subtrees extracted from a GumTree diff, keyed by
+    the git blob SHAs of the before/after sources and the extractor version. Pairs GumTree could not
+    parse are cached as well, so a hit skips both the JVM and the dot parsing.
+    """
+    SYNTAX_ERROR = 'syntax_error'
+
+    def __init__(self, path, version, max_bytes=4 * 1024 ** 3):
+        super().__init__(path, max_bytes)
+        self.version = version
+
+    @staticmethod
+    def blob_sha(content):
+        data = content.encode('utf-8', errors='surrogateescape')
+        return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+    def make_key(self, filepath, before, after):
+        # the extension is part of the key because it selects the GumTree parser
+        ext = filepath.rsplit('.', 1)[-1]
+        return '{}:{}:{}:{}'.format(self.blob_sha(before), self.blob_sha(after), ext, self.version)
+
+    def get_subtrees(self, filepath, before, after):
+        """
+        :return: None on a miss, SYNTAX_ERROR or a (b_subtree, a_subtree) pair on a hit
+        """
+        value = self.get(self.make_key(filepath, before, after))
+        if value is None:
+            return None
+        value = json.loads(value)
+        return value if value == self.SYNTAX_ERROR else tuple(value)
+
+    def put_subtrees(self, filepath, before, after, subtrees):
+        self.put(self.make_key(filepath, before, after), json.dumps(subtrees).encode('utf-8'))
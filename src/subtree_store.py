@@ -0,0 +1,139 @@
+import argparse
+import glob
+import json
+import os
+import re
+import struct
+import zlib
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+data_path = os.path.join(BASE_DIR, 'data')
+
+
+class SubtreeStore:
+    """
+    Append-only store of the subtrees of one shard, one record per commit.
+    `<path>.dat` holds framed records: magic, commit hash (20 bytes), payload length and crc32,
+    followed by the zlib compressed JSON list of (filepath, b_subtree, a_subtree).
+    `<path>.idx` has a `hash offset length` line per record, so resuming never reads the payloads.
+    A record is written and flushed before its index line; on open, records missing from the index
+    are re-indexed and a partially written tail is truncated.
+    """
+    MAGIC = b'JITS'
+    HEADER = struct.Struct('<4s20sII')
+
+    def __init__(self, path, sync=False):
+        self.data_file = path + '.dat'
+        self.index_file = path + '.idx'
+        self.sync = sync
+        self.index = dict()  # commit hash -> (offset, payload length)
+        self.recover()
+        self.data = open(self.data_file, 'ab')
+        self.index_out = open(self.index_file, 'a')
+
+    def recover(self):
+        size = os.path.getsize(self.data_file) if os.path.isfile(self.data_file) else 0
+        end = 0
+        stale_index = not os.path.isfile(self.index_file)
+        if not stale_index:
+            with open(self.index_file) as file:
+                for line in file:
+                    parts = line.split()
+                    if not line.endswith('\n') or len(parts) != 3 or \
+                            int(parts[1]) + self.HEADER.size + int(parts[2]) > size:
+                        stale_index = True
+                        break
+                    offset, length = int(parts[1]), int(parts[2])
+                    self.index[parts[0]] = (offset, length)
+                    end = max(end, offset + self.HEADER.size + length)
+        indexed = len(self.index)
+        with open(self.data_file, 'a+b') as file:
+            file.seek(end)
+            while True:
+                header = file.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    break
+                magic, commit, length, crc = self.HEADER.unpack(header)
+                payload = file.read(length)
+                if magic != self.MAGIC or len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                self.index[commit.hex()] = (end, length)
+                end += self.HEADER.size + length
+            file.truncate(end)
+        if stale_index or len(self.index) != indexed:
+            self.write_index()
+
+    def write_index(self):
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as file:
+            for commit, (offset, length) in self.index.items():
+                file.write('{} {} {}\n'.format(commit, offset, length))
+        os.replace(tmp, self.index_file)
+
+    def append(self, commit, subtrees):
+        payload = zlib.compress(json.dumps(subtrees).encode('utf-8'))
+        offset = self.data.tell()
+        self.data.write(self.HEADER.pack(self.MAGIC, bytes.fromhex(commit), len(payload), zlib.crc32(payload)))
+        self.data.write(payload)
+        self.data.flush()
+        if self.sync:
+            os.fsync(self.data.fileno())
+        self.index_out.write('{} {} {}\n'.format(commit, offset, len(payload)))
+        self.index_out.flush()
+        self.index[commit] = (offset, len(payload))
+
+    def get(self, commit):
+        offset, length = self.index[commit]
+        with open(self.data_file, 'rb') as file:
+            file.seek(offset + self.HEADER.size)
+            payload = file.read(length)
+        return json.loads(zlib.decompress(payload))
+
+    def items(self):
+        with open(self.data_file, 'rb') as file:
+            for commit, (offset, length) in self.index.items():
+                file.seek(offset + self.HEADER.size)
+                yield commit, json.loads(zlib.decompress(file.read(length)))
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, commit):
+        return commit in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.data.close()
+        self.index_out.close()
+
+
+def shard_path(ast_filename, file_index):
+    return os.path.join(data_path, ast_filename + '_{}'.format(file_index))
+
+
+def convert_json_shards(ast_filename):
+    """
+    converts the `<ast_filename>_N.json` shards written by RunHandler into SubtreeStore shards
+    """
+    pattern = re.compile(re.escape(ast_filename) + '_([0-9]+)\\.json$')
+    for json_file in sorted(glob.glob(os.path.join(data_path, ast_filename + '_*.json'))):
+        match = pattern.search(json_file)
+        if not match:
+            continue
+        with open(json_file) as file:
+            ast_dict = json.load(file)
+        store = SubtreeStore(shard_path(ast_filename, match.group(1)))
+        for commit, subtrees in ast_dict.items():
+            if commit not in store:
+                store.append(commit, subtrees)
+        print('{}: {} commits converted.'.format(json_file, len(store)))
+        store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--convert", default=None, type=str, help="ast filename of the json shards to convert")
+    args = parser.parse_args()
+    convert_json_shards(args.convert)
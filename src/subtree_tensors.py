@@ -0,0 +1,204 @@
+import argparse
+import glob
+import json
+import os
+import re
+from array import array
+
+import numpy as np
+
+from subtree_store import SubtreeStore
+
+BASE_PATH = os.path.dirname(os.path.dirname(__file__))
+data_path = os.path.join(BASE_PATH, 'data')
+
+FORMAT_VERSION = 1
+# name -> dtype of the flat binary arrays, all of them are memory-mapped by SubtreeTensors
+ARRAYS = {'commits': np.uint8,  # (commits, 20) raw commit hashes
+          'commit_files': np.int64,  # (commits + 1) offsets into the files
+          'graph_nodes': np.int64,  # (graphs + 1) offsets into labels and colors, graphs 2i, 2i+1 belong to file i
+          'graph_edges': np.int64,  # (graphs + 1) offsets into edges
+          'labels': np.int32,  # (nodes) ids into vocab.json
+          'colors': np.uint8,  # (ceil(nodes / 8)) packed bits, 1 for red nodes
+          'edges': np.int32}  # (edges, 2) source and destination, local to their graph
+
+
+def iter_shards(ast_filename, source='auto'):
+    """
+    yields (commit, subtrees_list) over the RunHandler shards in file order, from the SubtreeStore
+    shards when they exist (or source='store') and from the json shards otherwise
+    """
+    shards = dict()
+    for kind, ext in (('json', '.json'), ('store', '.dat')):
+        pattern = re.compile(re.escape(ast_filename) + '_([0-9]+)' + re.escape(ext) + '$')
+        for path in glob.glob(os.path.join(data_path, ast_filename + '_*' + ext)):
+            match = pattern.search(path)
+            if match:
+                shards.setdefault(int(match.group(1)), dict())[kind] = path
+    for i in sorted(shards):
+        if 'store' in shards[i] and source != 'json':
+            store = SubtreeStore(shards[i]['store'][:-len('.dat')])
+            yield from store.items()
+            store.close()
+        elif 'json' in shards[i] and source != 'store':
+            with open(shards[i]['json']) as file:
+                yield from json.load(file).items()
+
+
+class TensorWriter:
+    """
+    streams subtrees into flat binary arrays, see ARRAYS for the layout
+    """
+    FLUSH_SIZE = 1 << 20
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        self.files = {name: open(os.path.join(out_dir, name + '.bin'), 'wb') for name in ARRAYS}
+        self.buffers = {name: array('q' if ARRAYS[name] == np.int64 else 'i') for name in
+                        ('commit_files', 'graph_nodes', 'graph_edges', 'labels', 'edges')}
+        self.pending_colors = bytearray()
+        self.paths = open(os.path.join(out_dir, 'paths.txt'), 'w')
+        self.vocab = dict()
+        self.counts = {'commits': 0, 'files': 0, 'graphs': 0, 'nodes': 0, 'edges': 0}
+        self.buffers['commit_files'].append(0)
+        self.buffers['graph_nodes'].append(0)
+        self.buffers['graph_edges'].append(0)
+
+    def label_id(self, label):
+        if label not in self.vocab:
+            self.vocab[label] = len(self.vocab)
+        return self.vocab[label]
+
+    def add_graph(self, subtree):
+        features, edge_index, colors = subtree
+        if features == ['None']:  # the empty side of a file changed on one side only
+            features = []
+        labels = self.buffers['labels']
+        for feature in features:
+            labels.append(self.label_id(feature[0]))
+        self.pending_colors.extend(1 if c == 'red' else 0 for c in colors)
+        edges = self.buffers['edges']
+        for src, dst in zip(edge_index[0], edge_index[1]):
+            edges.append(src)
+            edges.append(dst)
+        self.counts['graphs'] += 1
+        self.counts['nodes'] += len(features)
+        self.counts['edges'] += len(edge_index[0])
+        self.buffers['graph_nodes'].append(self.counts['nodes'])
+        self.buffers['graph_edges'].append(self.counts['edges'])
+
+    def add_commit(self, commit, subtrees_list):
+        self.files['commits'].write(bytes.fromhex(commit))
+        for filepath, b_subtree, a_subtree in subtrees_list:
+            self.paths.write(filepath + '\n')
+            self.add_graph(b_subtree)
+            self.add_graph(a_subtree)
+            self.counts['files'] += 1
+        self.counts['commits'] += 1
+        self.buffers['commit_files'].append(self.counts['files'])
+        if len(self.buffers['labels']) + len(self.buffers['edges']) > self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self, final=False):
+        for name, buffer in self.buffers.items():
+            buffer.tofile(self.files[name])
+            del buffer[:]
+        full = len(self.pending_colors) if final else len(self.pending_colors) // 8 * 8
+        if full:
+            np.packbits(np.frombuffer(bytes(self.pending_colors[:full]), dtype=np.uint8)) \
+                .tofile(self.files['colors'])
+            del self.pending_colors[:full]
+
+    def close(self):
+        self.flush(final=True)
+        for file in self.files.values():
+            file.close()
+        self.paths.close()
+        vocab = sorted(self.vocab, key=self.vocab.get)
+        with open(os.path.join(self.out_dir, 'vocab.json'), 'w') as file:
+            json.dump(vocab, file)
+        with open(os.path.join(self.out_dir, 'meta.json'), 'w') as file:
+            json.dump(dict(self.counts, version=FORMAT_VERSION, vocab=len(vocab)), file, indent=1)
+
+
+class SubtreeTensors:
+    """
+    read side of the export: every array is a memmap, a commit's graphs are sliced out by offsets
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, 'meta.json')) as file:
+            self.meta = json.load(file)
+        shapes = {'commits': (self.meta['commits'], 20), 'commit_files': (self.meta['commits'] + 1,),
+                  'graph_nodes': (self.meta['graphs'] + 1,), 'graph_edges': (self.meta['graphs'] + 1,),
+                  'labels': (self.meta['nodes'],), 'colors': ((self.meta['nodes'] + 7) // 8,),
+                  'edges': (self.meta['edges'], 2)}
+        for name, dtype in ARRAYS.items():
+            path = os.path.join(out_dir, name + '.bin')
+            # np.memmap cannot map empty files
+            setattr(self, name, np.memmap(path, dtype=dtype, mode='r', shape=shapes[name])
+                    if os.path.getsize(path) else np.zeros(shapes[name], dtype=dtype))
+        self.index = None
+        self.paths = None
+        self.vocab = None
+
+    def load_vocab(self):
+        if self.vocab is None:
+            with open(os.path.join(self.out_dir, 'vocab.json')) as file:
+                self.vocab = json.load(file)
+        return self.vocab
+
+    def commit_index(self, commit):
+        if self.index is None:
+            hexes = np.ascontiguousarray(self.commits).tobytes().hex()
+            self.index = {hexes[i * 40:(i + 1) * 40]: i for i in range(len(self.commits))}
+        return self.index[commit]
+
+    def graph(self, g):
+        """
+        :return: (labels, edges, red) of graph g, int32 label ids, (edges, 2) int32 and a bool mask
+        """
+        start, end = int(self.graph_nodes[g]), int(self.graph_nodes[g + 1])
+        bits = np.unpackbits(self.colors[start // 8:(end + 7) // 8])
+        red = bits[start % 8:start % 8 + end - start].astype(bool)
+        return self.labels[start:end], self.edges[self.graph_edges[g]:self.graph_edges[g + 1]], red
+
+    def commit(self, commit):
+        """
+        :return: list of (filepath, before graph, after graph) of a commit
+        """
+        if self.paths is None:
+            with open(os.path.join(self.out_dir, 'paths.txt')) as file:
+                self.paths = file.read().split('\n')
+        i = self.commit_index(commit)
+        return [(self.paths[f], self.graph(2 * f), self.graph(2 * f + 1))
+                for f in range(int(self.commit_files[i]), int(self.commit_files[i + 1]))]
+
+    def __len__(self):
+        return self.meta['commits']
+
+
+def export_tensors(ast_filename, out_dir=None, source='auto'):
+    out_dir = out_dir or os.path.join(data_path, ast_filename + '_tensors')
+    writer = TensorWriter(out_dir)
+    seen = set()
+    for commit, subtrees_list in iter_shards(ast_filename, source):
+        if commit in seen:  # a commit can be in a json shard and in its converted store
+            continue
+        seen.add(commit)
+        writer.add_commit(commit, subtrees_list)
+    writer.close()
+    print('{commits} commits, {files} files, {nodes} nodes, {edges} edges'.format(**writer.counts),
+          '{} labels'.format(len(writer.vocab)))
+    return out_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ast-filename", required=True, type=str, help="ast filename of the RunHandler shards")
+    parser.add_argument("--out", default=None, type=str, help="output directory, data/<ast filename>_tensors by default")
+    parser.add_argument("--source", default='auto', choices=['auto', 'json', 'store'], help="shard format to read")
+    args = parser.parse_args()
+    export_tensors(args.ast_filename, args.out, args.source)
@@ -0,0 +1,353 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+PENDING, LEASED, DONE, FAILED = 'pending', 'leased', 'done', 'failed'
+FINAL = '/final'  # suffix of the queue holding the one finalization item of a queue
+
+
+class WorkQueue:
+    """
+    A durable work queue on top of SQLite (WAL), shared by the processes of one host. Items are claimed in
+    batches under a lease that a heartbeat thread extends while they are processed. A result is stored in
+    the same transaction that marks its item done, and only by the worker that still holds the lease, so a
+    crashed worker's items are handed out again once their lease expires and no item is ever completed
+    twice. A failed item is retried after a backoff that doubles with every attempt, and items that fail
+    max_attempts times are parked as failed until retried. Several named queues can share one database file.
+
+    The database must be on a local disk and used from a single host: WAL needs shared memory between the
+    processes, which SQLite does not support over network filesystems, and leases are compared against the
+    local clock.
+    """
+
+    def __init__(self, path, name, lease=600, max_attempts=3, backoff=30):
+        self.path = path
+        self.name = name
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.worker = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.held = set()
+        self.held_lock = threading.Lock()
+        self.finalize_started = None
+        self.pid = None
+        self._conn = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS items '
+                          '(queue TEXT, key TEXT, payload TEXT, status TEXT, owner TEXT, lease_until REAL, '
+                          'attempts INTEGER, error TEXT, result BLOB, updated REAL, PRIMARY KEY (queue, key))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS items_status ON items (queue, status)')
+        if 'not_before' not in [column[1] for column in self.conn.execute('PRAGMA table_info(items)')]:
+            self.conn.execute('ALTER TABLE items ADD COLUMN not_before REAL')
+
+    @property
+    def conn(self):
+        # sqlite connections must not cross a fork, a forked worker opens its own
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.worker = '{}:{}:{}'.format(socket.gethostname(), self.pid, uuid.uuid4().hex[:8])
+            self.held = set()
+            self._conn = self.connect()
+        return self._conn
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_conn=None, pid=None, held=set(), held_lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.held_lock = threading.Lock()
+
+    def transaction(self, conn=None):
+        return Transaction(conn or self.conn)
+
+    def add(self, items):
+        """
+        enqueues (key, payload) pairs, keys that are already in the queue are left as they are,
+        so every process of a stage can enqueue the same items. payloads must be JSON serializable
+        :return: number of new items
+        """
+        now = time.time()
+        rows = [(self.name, key, json.dumps(payload), PENDING, now) for key, payload in items]
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO items (queue, key, payload, status, attempts, updated) '
+                             'VALUES (?, ?, ?, ?, 0, ?)', rows)
+            added = conn.total_changes - before
+            if added:  # new work reopens a finished finalization, a running one reopens itself in finish_finalize
+                conn.execute('UPDATE items SET status = ?, attempts = 0 WHERE queue = ? AND status = ?',
+                             (PENDING, self.name + FINAL, DONE))
+        return added
+
+    def claim(self, n=1, queue=None):
+        """
+        leases up to n items, pending ones past their backoff and those whose lease expired, in the order
+        they were added
+        :return: list of (key, payload)
+        """
+        queue = queue or self.name
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('UPDATE items SET status = ?, error = ?, updated = ? '
+                         'WHERE queue = ? AND status = ? AND lease_until < ? AND attempts >= ?',
+                         (FAILED, 'lease expired', now, queue, LEASED, now, self.max_attempts))
+            rows = conn.execute('SELECT key, payload FROM items WHERE queue = ? AND '
+                                '((status = ? AND (not_before IS NULL OR not_before <= ?)) OR '
+                                '(status = ? AND lease_until < ?)) ORDER BY rowid LIMIT ?',
+                                (queue, PENDING, now, LEASED, now, n)).fetchall()
+            conn.executemany('UPDATE items SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1, '
+                             'updated = ? WHERE queue = ? AND key = ?',
+                             [(LEASED, self.worker, now + self.lease, now, queue, key) for key, _ in rows])
+        with self.held_lock:
+            self.held.update((queue, key) for key, _ in rows)
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def heartbeat(self, conn=None):
+        """
+        extends the leases of the items this worker holds
+        :return: number of leases extended, leases already taken over by another worker are dropped
+        """
+        with self.held_lock:
+            held = list(self.held)
+        if not held:
+            return 0
+        now = time.time()
+        with self.transaction(conn) as conn:
+            extended = 0
+            for queue, key in held:
+                extended += conn.execute('UPDATE items SET lease_until = ?, updated = ? WHERE queue = ? AND key = ? '
+                                         'AND owner = ? AND status = ?',
+                                         (now + self.lease, now, queue, key, self.worker, LEASED)).rowcount
+        return extended
+
+    def complete(self, results, queue=None):
+        """
+        stores the results of held items and marks them done, all in one transaction
+        :param results: dict key -> JSON serializable result
+        :return: keys that were completed, keys whose lease was lost meanwhile are not
+        """
+        queue = queue or self.name
+        now = time.time()
+        completed = []
+        with self.transaction() as conn:
+            for key, result in results.items():
+                blob = zlib.compress(json.dumps(result).encode('utf-8'))
+                if conn.execute('UPDATE items SET status = ?, result = ?, error = NULL, updated = ? '
+                                'WHERE queue = ? AND key = ? AND owner = ? AND status = ?',
+                                (DONE, blob, now, queue, key, self.worker, LEASED)).rowcount:
+                    completed.append(key)
+        self.drop(queue, results)
+        return completed
+
+    def fail(self, key, error, queue=None):
+        """
+        returns a held item to the queue after a backoff of backoff * 2 ** (attempts - 1) seconds,
+        or parks it as failed after max_attempts
+        """
+        queue = queue or self.name
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('UPDATE items SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, '
+                         'not_before = ? + ? * (1 << (attempts - 1)), updated = ? '
+                         'WHERE queue = ? AND key = ? AND owner = ? AND status = ?',
+                         (self.max_attempts, FAILED, PENDING, str(error), now, self.backoff, now, queue, key,
+                          self.worker, LEASED))
+        self.drop(queue, [key])
+
+    def release(self, keys, queue=None):
+        """
+        returns held items to the queue without counting the attempt, e.g. on a clean shutdown
+        """
+        queue = queue or self.name
+        with self.transaction() as conn:
+            conn.executemany('UPDATE items SET status = ?, attempts = attempts - 1, updated = ? '
+                             'WHERE queue = ? AND key = ? AND owner = ? AND status = ?',
+                             [(PENDING, time.time(), queue, key, self.worker, LEASED) for key in keys])
+        self.drop(queue, keys)
+
+    def drop(self, queue, keys):
+        with self.held_lock:
+            self.held.difference_update((queue, key) for key in keys)
+
+    def retry_failed(self):
+        return self.conn.execute('UPDATE items SET status = ?, attempts = 0, not_before = NULL, updated = ? '
+                                 'WHERE queue = ? AND status = ?', (PENDING, time.time(), self.name, FAILED)).rowcount
+
+    def retry_wait(self):
+        """
+        :return: seconds until the next pending item is past its backoff, None if no item is waiting
+        """
+        not_before, = self.conn.execute('SELECT MIN(not_before) FROM items WHERE queue = ? AND status = ?',
+                                        (self.name, PENDING)).fetchone()
+        return None if not_before is None else max(not_before - time.time(), 0)
+
+    def counts(self, queue=None):
+        rows = self.conn.execute('SELECT status, COUNT(*) FROM items WHERE queue = ? GROUP BY status',
+                                 (queue or self.name,)).fetchall()
+        return dict({PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}, **dict(rows))
+
+    def drained(self):
+        # items waiting for their backoff are pending, the queue is not drained until they are retried
+        counts = self.counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def results(self):
+        """
+        yields (key, payload, result) of the done items in the order they were added
+        """
+        for key, payload, result in self.conn.execute('SELECT key, payload, result FROM items '
+                                                      'WHERE queue = ? AND status = ? ORDER BY rowid',
+                                                      (self.name, DONE)):
+            yield key, json.loads(payload), json.loads(zlib.decompress(result))
+
+    def failed(self):
+        return self.conn.execute('SELECT key, error FROM items WHERE queue = ? AND status = ? ORDER BY rowid',
+                                 (self.name, FAILED)).fetchall()
+
+    def run(self, work, batch=10, heartbeat_interval=None):
+        """
+        claims batches until the queue has no claimable items left, calls work(key, payload) for each item
+        and completes every batch at once. an exception fails only its own item, which is retried by this
+        or another worker after its backoff.
+        :return: number of items completed by this worker
+        """
+        heartbeat = Heartbeat(self, heartbeat_interval or self.lease / 3)
+        completed = 0
+        try:
+            while True:
+                items = self.claim(batch)
+                if not items:
+                    wait = self.retry_wait()
+                    if wait is None:
+                        break
+                    time.sleep(wait)
+                    continue
+                results = dict()
+                for key, payload in items:
+                    try:
+                        results[key] = work(key, payload)
+                    except Exception as e:
+                        logging.exception('{} item {} failed'.format(self.name, key))
+                        self.fail(key, repr(e))
+                completed += len(self.complete(results))
+                logging.info('{}: {} completed by {}, {}'.format(self.name, completed, self.worker, self.counts()))
+        finally:
+            heartbeat.stop()
+            with self.held_lock:
+                held = [key for queue, key in self.held if queue == self.name]
+            if held:  # interrupted, hand the rest of the batch back
+                self.release(held)
+        return completed
+
+    def try_finalize(self):
+        """
+        once all items are done or failed, leases the queue's single finalization item (writing the outputs of
+        the stage) to one worker. the writer is expected to be idempotent: when it dies, the lease expires
+        and another worker finalizes again.
+        :return: True if this worker should finalize and then call finish_finalize()
+        """
+        if not self.drained():
+            return False
+        self.finalize_started = time.time()
+        final = self.name + FINAL
+        self.conn.execute('INSERT OR IGNORE INTO items (queue, key, payload, status, attempts, updated) '
+                          'VALUES (?, ?, ?, ?, 0, ?)', (final, '', 'null', PENDING, time.time()))
+        return len(self.claim(1, queue=final)) > 0
+
+    def finish_finalize(self):
+        final = self.name + FINAL
+        with self.transaction() as conn:
+            conn.execute('UPDATE items SET status = ?, result = ?, error = NULL, updated = ? '
+                         'WHERE queue = ? AND key = ? AND owner = ? AND status = ?',
+                         (DONE, zlib.compress(b'null'), time.time(), final, '', self.worker, LEASED))
+            # items added or retried since the queue was found drained are not in the outputs, finalize again
+            if conn.execute('SELECT 1 FROM items WHERE queue = ? AND updated > ? LIMIT 1',
+                            (self.name, self.finalize_started)).fetchone() is not None:
+                conn.execute('UPDATE items SET status = ?, attempts = 0 WHERE queue = ? AND status = ?',
+                             (PENDING, final, DONE))
+        self.drop(final, [''])
+
+    def close(self):
+        if self._conn is not None and self.pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self.pid = None
+
+
+class Transaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT, the write lock is taken up front so concurrent claims serialize
+    instead of failing on lock upgrades
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class Heartbeat:
+    """
+    extends the leases of a WorkQueue's held items from a background thread with its own connection
+    """
+
+    def __init__(self, queue, interval):
+        self.queue = queue
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        conn = self.queue.connect()
+        while not self.stopped.wait(self.interval):
+            try:
+                self.queue.heartbeat(conn)
+            except sqlite3.Error:
+                logging.exception('{} heartbeat failed'.format(self.queue.name))
+        conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="queue database")
+    parser.add_argument("--queue", default=None, type=str, help="queue name, all queues by default")
+    parser.add_argument("--retry-failed", action='store_true', help="return the failed items to the queue")
+    parser.add_argument("--show-failed", action='store_true', help="print the failed items and their errors")
+    args = parser.parse_args()
+
+    names = [args.queue] if args.queue else [name for name, in sqlite3.connect(args.path).execute(
+        'SELECT DISTINCT queue FROM items ORDER BY queue') if not name.endswith(FINAL)]
+    for name in names:
+        queue = WorkQueue(args.path, name)
+        if args.retry_failed:
+            print('{}: {} failed items returned to the queue'.format(name, queue.retry_failed()))
+        print('{}: {}'.format(name, queue.counts()))
+        if args.show_failed:
+            for key, error in queue.failed():
+                print('\t{}\t{}'.format(key, error))
+        queue.close()